@@ -1,5 +1,5 @@
 from pathlib import Path
-from scripts.data_processing import parse, plot, utils
+from scripts.data_processing import parse, plot, utils, store
 from datetime import datetime
 import numpy as np
 import argparse
@@ -22,13 +22,12 @@ def list_participants(raw_path, processed_path):
 
 
 def flag_and_order_participants(raw_path, processed_path, participants):
+    participants_flags = utils.load_participants_flags(processed_path) if processed_path.exists() else None
     for i, participant in enumerate(participants):
         processed_trials_path = processed_path / participant
         raw_trials_path = raw_path / participant
         if processed_trials_path.exists():
-            processed_trials = [dir_.name for dir_ in utils.get_dirs(processed_trials_path)]
-            trials_flags = utils.load_flags(processed_trials, processed_trials_path)
-            edited_trials = [trials_flags[trial]['edited'] for trial in trials_flags]
+            edited_trials = participants_flags.loc[participants_flags['subj'] == participant, 'edited'].tolist()
             all_trials = [trial.stem for trial in utils.get_files(raw_trials_path, extension='mat')
                           if trial.stem != 'Test' and trial.stem != 'metadata']
             all_edited = np.all(edited_trials) and len(edited_trials) == len(all_trials)
@@ -108,7 +107,7 @@ def list_options(options, prompt):
 
 def read_words_associations(questions_file, item, trial_path):
     _, _, words = utils.load_questions_and_words(questions_file, item)
-    answers = utils.load_answers(trial_path, filename='words.pkl')
+    answers = utils.load_answers(trial_path, 'words')
     if len(words) == 0:
         print('No words found for this item')
         return
@@ -122,7 +121,7 @@ def read_words_associations(questions_file, item, trial_path):
 
 def read_questions_and_answers(questions_file, item, trial_path):
     questions, possible_answers, _ = utils.load_questions_and_words(questions_file, item)
-    answers = utils.load_answers(trial_path, filename='answers.pkl')
+    answers = utils.load_answers(trial_path, 'answers')
     if len(questions) == 0:
         print('No questions found for this item')
         return 0
@@ -143,13 +142,16 @@ def load_subj_trials(subj_rawpath, ascii_path, config, stimuli_path, data_path):
     subj_items = [item.name[:-4] for item in subj_rawpath.glob('*.mat')
                   if item.name not in ['Test.mat', 'metadata.mat']]
     if data_path.exists():
-        subj_processeditems = [item.name for item in data_path.iterdir() if item.is_dir()]
+        subj_processeditems = [item.name for item in data_path.iterdir() if item.is_dir() and store.trial_exists(item)]
         missing_items = [item for item in subj_items if item not in subj_processeditems]
     else:
         missing_items = subj_items
         parse.save_profile(subj_rawpath, data_path)
-    for rawitem in missing_items:
-        parse.item(subj_rawpath / f'{rawitem}.mat', subj_rawpath, ascii_path, config, stimuli_path, data_path)
+    if missing_items:
+        trials = [(subj_rawpath / f'{rawitem}.mat', subj_rawpath, data_path) for rawitem in missing_items]
+        failed_trials = parse.process_trials(trials, ascii_path, config, stimuli_path)
+        failed_items = {trial_path.name for trial_path, _ in failed_trials}
+        subj_items = [item for item in subj_items if item not in failed_items]
     subj_profile = utils.load_profile(data_path)
     subj_items = utils.reorder(subj_items, subj_profile['stimuli_order'][0])
     return subj_items, subj_profile
@@ -4,26 +4,35 @@ import seaborn as sns
 import matplotlib.pyplot as plt
 from pymer4 import Lmer
 import argparse
+import hashlib
+import json
 from pathlib import Path
 from scripts.data_processing.extract_measures import main as extract_measures
 from scripts.data_processing.wa_task import parse_wa_task
-from scripts.data_processing.utils import get_dirs, get_files, log
+from scripts.data_processing import store, aggregates
 
 """ Script to perform data analysis on eye-tracking measures. It is composed of three steps:
     1. Assign the fixations from each trial to their corresponding word in the text
     2. Extract measures from fixations (FFD, FPRT, RPD, TFD, FC, etc.)
     3. Perform data analysis on the extracted measures """
 
+ANALYSIS_TABLE = 'analysis_table.npz'
+# Bumped whenever the columns of the analysis table change, so that cached tables are rebuilt
+ANALYSIS_TABLE_VERSION = 1
+# Positions normalized by their maximum within each group
+POSITIONS_GROUPS = {'word_idx': ['subj', 'item'], 'screen_pos': ['subj', 'item', 'screen'],
+                    'sentence_pos': ['sentence_idx']}
 
-def do_analysis(items_paths, words_freq_file, stats_file, save_path):
+
+def do_analysis(measures_path, items, words_freq_file, stats_file, save_path):
     print('Analysing eye-tracking measures...')
-    words_freq, items_stats = pd.read_csv(words_freq_file), pd.read_csv(stats_file, index_col=0)
-    et_measures = load_et_measures(items_paths, words_freq)
+    items_stats = pd.read_csv(stats_file, index_col=0)
+    et_measures = load_analysis_table(measures_path, words_freq_file, items, save_path)
     print_stats(et_measures, items_stats, save_path)
 
     et_measures = remove_excluded_words(et_measures)
     plot_measures(et_measures, save_path)
-    mlm_analysis(log_normalize_durations(et_measures), words_freq)
+    mlm_analysis(log_normalize_durations(et_measures))
 
 
 def print_stats(et_measures, items_stats, save_path):
@@ -56,17 +65,13 @@ def plot_measures(et_measures, save_path):
     plot_words_effects(et_measures, save_path)
 
 
-def mlm_analysis(et_measures, words_freq):
-    et_measures['word_len'] = et_measures['word'].apply(lambda x: 1 / len(x) if x else 0)
-    et_measures['word_freq'] = et_measures['word'].apply(lambda x:
-                                                         log(words_freq.loc[words_freq['word'] == x, 'cnt'].values[0])
-                                                         if x in words_freq['word'].values else 0)
+def mlm_analysis(et_measures):
+    # Words are categorical, so this is computed once per distinct word
+    et_measures['word_len'] = et_measures['word'].apply(lambda x: 1 / len(x) if x else 0).astype(float)
+    et_measures['word_freq'] = et_measures.pop('word_log_freq')
     et_measures = et_measures.loc[et_measures['word_freq'] != 0, :].copy()
-
-    et_measures['word_idx'] = et_measures.groupby(['subj', 'item'])['word_idx'].transform(lambda x: x / x.max())
-    et_measures['screen_pos'] = (et_measures.groupby(['subj', 'item', 'screen'])['screen_pos']
-                                 .transform(lambda x: x / x.max()))
-    et_measures['sentence_pos'] = et_measures.groupby('sentence_idx')['sentence_pos'].transform(lambda x: x / x.max())
+    for position in POSITIONS_GROUPS:
+        et_measures[position] = et_measures.pop(f'{position}_norm')
     et_measures['sentence_pos_squared'] = et_measures['sentence_pos'] * et_measures['sentence_pos']
     fixed_effects = ['word_len', 'word_freq', 'sentence_pos', 'sentence_pos_squared', 'word_idx', 'screen_pos']
     for fixed_effect in fixed_effects:
@@ -91,6 +96,10 @@ def mlm_analysis(et_measures, words_freq):
         fit_mlm(name, formula, et_measures)
 
 
+def normalize_by_max(et_measures, column, by):
+    return et_measures[column] / et_measures.groupby(by, observed=True)[column].transform('max')
+
+
 def fit_mlm(name, formula, data, model_family='gaussian'):
     model = Lmer(formula, data=data, family=model_family)
     results = model.fit()
@@ -115,20 +124,30 @@ def remove_excluded_words(et_measures):
     return et_measures
 
 
-def add_len_freq_skipped(et_measures, words_freq):
+def add_len_freq_skipped(et_measures, lexicon):
+    """ Words are looked up in the lexicon once per distinct word; those missing from it have a frequency of 0 """
     et_measures['skipped'] = et_measures[~et_measures['excluded']]['FFD'].apply(lambda x: int(x == 0))
-    et_measures['word_len'] = et_measures['word'].apply(lambda x: len(x))
-    words_freq = words_freq[['word', 'cnt']].copy()
-    words_freq['cnt'] = pd.qcut(words_freq['cnt'], 15, labels=[i for i in range(1, 16)])
-    et_measures['word_freq'] = et_measures['word'].apply(lambda x:
-                                                         words_freq.loc[words_freq['word'] == x, 'cnt'].values[0]
-                                                         if x in words_freq['word'].values else 0)
-    return et_measures
+    et_measures['word'] = et_measures['word'].astype('category')
+    et_measures['word_len'] = et_measures['word'].str.len()
+    words = et_measures['word'].cat
+    words_lexicon = lexicon.reindex(words.categories).fillna(0)
+    for column in words_lexicon:
+        et_measures[column] = words_lexicon[column].to_numpy()[words.codes]
+    return et_measures.astype({'word_freq': int})
+
+
+def load_lexicon(words_freq):
+    """ Frequency percentile (1 to 15) and log count of each word of the frequencies table """
+    lexicon = words_freq[['word', 'cnt']].copy()
+    lexicon['word_freq'] = pd.qcut(lexicon['cnt'], 15, labels=False) + 1
+    lexicon['word_log_freq'] = np.log(lexicon['cnt'].where(lexicon['cnt'] > 0, 1))
+    return lexicon.drop_duplicates('word').set_index('word').drop(columns=['cnt'])
 
 
 def log_normalize_durations(trial_measures):
     for duration_measure in ['FFD', 'SFD', 'FPRT', 'RPD', 'TFD', 'SPRT']:
-        trial_measures[duration_measure] = trial_measures[duration_measure].apply(lambda x: log(x))
+        durations = trial_measures[duration_measure]
+        trial_measures[duration_measure] = np.log(durations.where(durations > 0, 1))
     return trial_measures
 
 
@@ -194,21 +213,43 @@ def plot_histograms(et_measures, measures, ax_titles, y_labels, save_file):
     plt.show()
 
 
-def load_trial(trial, item_name, words_freq):
-    trial_measures = add_len_freq_skipped(pd.read_pickle(trial), words_freq)
-    trial_measures.insert(0, 'item', item_name)
-    return trial_measures
+def load_et_measures(measures_path, lexicon, items=None, columns=None):
+    measures = aggregates.load_measures(measures_path, columns=columns, items=items)
+    measures = add_len_freq_skipped(measures, lexicon)
+    return measures
 
 
-def load_trials_measures(item, words_freq):
-    trials_measures = [load_trial(trial, item.name, words_freq) for trial in get_files(item)]
-    return pd.concat(trials_measures, ignore_index=True)
+def load_analysis_table(measures_path, words_freq_file, items, save_path):
+    """ Measures with the words properties and normalized positions used in the analysis. The table is cached in
+        save_path and only rebuilt when the measures or the words frequencies change. """
+    table_file, fingerprint = save_path / ANALYSIS_TABLE, inputs_fingerprint(measures_path, words_freq_file, items)
+    if table_file.exists() and store.load_frames(table_file, ['fingerprint'])['fingerprint'].iloc[0, 0] == fingerprint:
+        return store.load_frames(table_file, ['measures'])['measures']
+    et_measures = load_et_measures(measures_path, load_lexicon(pd.read_csv(words_freq_file)), items)
+    et_measures = add_normalized_positions(et_measures)
+    save_path.mkdir(parents=True, exist_ok=True)
+    store.save_frames(table_file, {'measures': et_measures,
+                                   'fingerprint': pd.DataFrame({'fingerprint': [fingerprint]})})
+    return et_measures
 
 
-def load_et_measures(items_paths, words_freq):
-    measures = [load_trials_measures(item, words_freq) for item in items_paths]
-    measures = pd.concat(measures, ignore_index=True)
-    return measures
+def inputs_fingerprint(measures_path, words_freq_file, items):
+    """ Hash of the size and modification time of every input file of the analysis table, including the items'
+        aggregated states the across-trial measures are derived from """
+    files = [words_freq_file] + sorted(file for file in measures_path.glob('*/*')
+                                       if items is None or file.parent.name in items)
+    files += sorted(file for file in (measures_path.parent / aggregates.AGGREGATES_DIR).glob('*.npz')
+                    if items is None or file.stem in items)
+    inputs = [[str(file), file.stat().st_size, file.stat().st_mtime_ns] for file in files]
+    return hashlib.sha256(json.dumps([ANALYSIS_TABLE_VERSION, items, inputs]).encode()).hexdigest()
+
+
+def add_normalized_positions(et_measures):
+    """ Normalized over the words the models are fit on (not excluded and with a frequency), missing for the rest """
+    modeled_words = et_measures[~et_measures['excluded'] & (et_measures['word_log_freq'] != 0)]
+    for position, by in POSITIONS_GROUPS.items():
+        et_measures[f'{position}_norm'] = normalize_by_max(modeled_words, position, by)
+    return et_measures
 
 
 if __name__ == '__main__':
@@ -229,6 +270,8 @@ if __name__ == '__main__':
     parser.add_argument('-r', '--reprocess', action='store_true', help='Compute measures again, even if they exist')
     parser.add_argument('-o', '--output', type=str, default='results')
     parser.add_argument('-i', '--item', type=str, default='all')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of processes (all cores by default)')
+    parser.add_argument('-cs', '--chunksize', type=int, default=1, help='Number of trials sent to a process at a time')
     args = parser.parse_args()
 
     wordsfix_path, measures_path, stimuli_path, participants_path, save_path = \
@@ -236,15 +279,13 @@ if __name__ == '__main__':
     words_freq_file, stats_file, questions_file = Path(args.words_freq), Path(args.stats), Path(args.questions)
     subjects_associations, words_associations = parse_wa_task(questions_file, participants_path)
 
-    extract_measures(args.item, wordsfix_path, stimuli_path, participants_path, save_path, reprocess=args.reprocess)
+    extract_measures(args.item, wordsfix_path, stimuli_path, participants_path, save_path, reprocess=args.reprocess,
+                     jobs=args.jobs, chunksize=args.chunksize)
 
-    if args.item != 'all':
-        items_paths = [measures_path / args.item]
-    else:
-        items_paths = get_dirs(measures_path)
+    items = [args.item] if args.item != 'all' else None
 
     save_path.mkdir(parents=True, exist_ok=True)
     subjects_associations.to_csv(save_path / 'subjects_associations.csv')
     words_associations.to_csv(save_path / 'words_associations.csv', index=False)
 
-    do_analysis(items_paths, words_freq_file, stats_file, save_path)
+    do_analysis(measures_path, items, words_freq_file, stats_file, save_path)
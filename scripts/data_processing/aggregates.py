@@ -0,0 +1,149 @@
+from . import store, utils
+import pandas as pd
+
+""" Mergeable aggregated state of the measures of each item, so that processing new participants only requires
+    their trials and not the ones already processed.
+    For each word (word_idx), it keeps the number of subjects and, over them, the number of trials where it is
+    valid (not excluded), skipped (FPRT of 0) and regressed to (RRT > 0), plus the sums of its measures.
+    Measures are binned into quantiles within each subject's trial, so their binned values are final once computed
+    and can be summed. Across-trial measures (LS, RR) and averages are derived from the state.
+    It is saved with the processed subjects, the computed measures and the subjects' scanpaths in
+    <save_path>/aggregates/<item>.npz. The measures of each subject are saved in the <save_path>/measures dataset
+    without the across-trial ones, which change whenever subjects are added and are joined when loading it. """
+
+AGGREGATES_DIR = 'aggregates'
+MEASURES_DIR = 'measures'
+BINNED_MEASURES = ['FFD', 'SFD', 'FPRT', 'TFD', 'RPD', 'RRT', 'SPRT']
+COUNTED_MEASURES = ['FC', 'RC']
+N_BINS = 10
+# Across-trial measures: the rate of valid trials where a measure meets a condition (name: (measure, count, condition))
+TRIALS_RATES = {'LS': ('FPRT', 'n_skipped', lambda values: values == 0),
+                'RR': ('RRT', 'n_regressed', lambda values: values > 0)}
+
+
+def item_aggregates(item_measures):
+    """ State of the measures of a set of subjects of an item. Only the measures it has are aggregated. """
+    valid = ~item_measures['excluded']
+    counts = pd.DataFrame({'word_idx': item_measures['word_idx'], 'n_subj': 1, 'n_valid': valid})
+    for measure, count, condition in TRIALS_RATES.values():
+        if measure in item_measures:
+            counts[count] = valid & condition(item_measures[measure])
+    binned, counted = measures_columns(item_measures)
+    binned_measures = utils.bin_measures(item_measures, binned, N_BINS)
+    sums = pd.concat([counts, binned_measures[binned + counted].astype(float)], axis=1)
+    sums = sums.groupby('word_idx').sum()
+    words = item_measures.drop_duplicates('word_idx').set_index('word_idx')[['word', 'excluded']]
+    return words.astype({'word': str}).join(sums)
+
+
+def merge_aggregates(aggregates, new_aggregates):
+    if aggregates is None:
+        return new_aggregates
+    if not aggregates.columns.equals(new_aggregates.columns):
+        raise ValueError(f'aggregated measures differ: {list(aggregates.columns)} and {list(new_aggregates.columns)} '
+                         f'(process the item again with --reprocess)')
+    # sanity check: subjects of both states read the same words
+    assert aggregates.index.equals(new_aggregates.index) and aggregates['word'].equals(new_aggregates['word'])
+    aggregates = aggregates.copy()
+    summed = aggregates.columns.drop(['word', 'excluded'])
+    aggregates[summed] += new_aggregates[summed]
+    return aggregates
+
+
+def measures_columns(measures_df):
+    """ Binned and counted measures among the columns of measures_df """
+    return [measure for measure in BINNED_MEASURES if measure in measures_df], \
+        [measure for measure in COUNTED_MEASURES if measure in measures_df]
+
+
+def aggregated_measures(aggregates):
+    """ Across-trial measures (LS, RR) of each word, missing for excluded words """
+    n_valid = aggregates['n_valid'].where(aggregates['n_valid'] > 0)
+    return pd.DataFrame({rate: aggregates[count] / n_valid for rate, (_, count, _) in TRIALS_RATES.items()
+                         if count in aggregates}, index=aggregates.index).astype('float32')
+
+
+def average_measures(aggregates):
+    n_subj, (binned, counted) = aggregates['n_subj'], measures_columns(aggregates)
+    averaged_measures = aggregates[binned].div(n_subj, axis=0).astype('float32')
+    averaged_measures[counted] = aggregates[counted].div(n_subj, axis=0)
+    rates = aggregated_measures(aggregates)
+    averaged_measures[rates.columns] = rates
+    averaged_measures['word'] = aggregates['word']
+    averaged_measures['excluded'] = aggregates['excluded']
+    return averaged_measures
+
+
+def load_measures(measures_path, columns=None, items=None, subjects=None):
+    """ Loads the measures dataset (see store.load_dataset) with the across-trial measures of the words of each item,
+        derived from the items' states, which are saved next to it (in measures_path.parent) """
+    items_paths = sorted(path for path in measures_path.iterdir() if path.is_dir()
+                         and (items is None or path.name in items))
+    items_measures = [load_item_measures(measures_path, item_path.name, columns, subjects) for item_path in items_paths]
+    items_measures = [item_measures for item_measures in items_measures if not item_measures.empty]
+    if not items_measures:
+        return pd.DataFrame(columns=['item'] + (columns or []))
+    return store.concat_frames(items_measures)
+
+
+def load_item_measures(measures_path, item_name, columns=None, subjects=None):
+    file = aggregates_file(measures_path.parent, item_name)
+    if not file.exists():
+        # Measures saved before the states were kept have their across-trial measures
+        return store.load_dataset(measures_path, columns, [item_name], subjects)
+    rates = [rate for rate in TRIALS_RATES if columns is None or rate in columns]
+    dataset_columns = None if columns is None else [column for column in columns if column not in TRIALS_RATES]
+    if dataset_columns is not None and rates and 'word_idx' not in dataset_columns:
+        dataset_columns.append('word_idx')
+    item_measures = store.load_dataset(measures_path, dataset_columns, [item_name], subjects)
+    # Partitions saved along with their across-trial measures have them as of when they were saved
+    item_measures = item_measures.drop(columns=[rate for rate in TRIALS_RATES if rate in item_measures])
+    words_rates = aggregated_measures(store.load_frames(file, ['words'])['words'])
+    for rate in [rate for rate in rates if rate in words_rates]:
+        item_measures[rate] = words_rates[rate].loc[item_measures['word_idx']].to_numpy()
+    if columns is None:
+        return item_measures
+    return item_measures[['item'] + [column for column in columns if column in item_measures]]
+
+
+def aggregates_file(save_path, item_name):
+    return save_path / AGGREGATES_DIR / f'{item_name}.npz'
+
+
+def load_aggregates(save_path, item_name):
+    """ State, processed subjects and scanpaths of an item (None, [] and {} if it has not been processed) """
+    file = aggregates_file(save_path, item_name)
+    if not file.exists():
+        return None, [], {}
+    frames = store.load_frames(file)
+    scanpaths = {subj: {'words': subj_scanpath['word'].tolist(), 'words_ids': subj_scanpath['word_idx'].tolist()}
+                 for subj, subj_scanpath in frames['scanpaths'].groupby('subj', sort=False)}
+    return frames['words'], frames['subjects']['subj'].tolist(), scanpaths
+
+
+def save_aggregates(save_path, item_name, aggregates, subjects, measures, scanpaths):
+    file = aggregates_file(save_path, item_name)
+    file.parent.mkdir(parents=True, exist_ok=True)
+    scanpaths = pd.DataFrame({'subj': [subj for subj in scanpaths for _ in scanpaths[subj]['words']],
+                              'word': [word for subj in scanpaths for word in scanpaths[subj]['words']],
+                              'word_idx': [idx for subj in scanpaths for idx in scanpaths[subj]['words_ids']]})
+    store.save_frames(file, {'words': aggregates, 'subjects': pd.DataFrame({'subj': subjects}),
+                             'measures': pd.DataFrame({'measure': list(measures)}), 'scanpaths': scanpaths})
+
+
+def processed_subjects(save_path, item_name):
+    file = aggregates_file(save_path, item_name)
+    if not file.exists():
+        return []
+    return store.load_frames(file, ['subjects'])['subjects']['subj'].tolist()
+
+
+def processed_measures(save_path, item_name):
+    """ Measures computed for the subjects of an item (None if it has not been processed) """
+    file = aggregates_file(save_path, item_name)
+    if not file.exists():
+        return None
+    if 'measures' not in store.frames_names(file):
+        # States saved before the measures were selectable have all of them
+        return list(BINNED_MEASURES + COUNTED_MEASURES)
+    return store.load_frames(file, ['measures'])['measures']['measure'].tolist()
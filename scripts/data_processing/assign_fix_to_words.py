@@ -1,108 +1,199 @@
 from pathlib import Path
 from tqdm import tqdm
-from scripts.data_processing import utils
+from scripts.data_processing import utils, store
 import pandas as pd
 import numpy as np
 import argparse
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
-
-def process_single_item(item, subjects, reprocess, save_path):
-    item_name = item.stem
-    screens_lines = utils.load_lines_by_screen(item)
-    item_savepath = save_path / item_name
-    item_savepath.mkdir(exist_ok=True, parents=True)
-    item_subjects = get_subjects_to_process(subjects, item_name, item_savepath, reprocess)
-    item_stats = {'n_subj': 0, 'n_fix': 0, 'n_words': 0, 'out_of_bounds': 0, 'return_sweeps': 0}
-    if item_subjects:
-        process_item(item_name, item_subjects, screens_lines, item_stats, item_savepath)
-    return item_name, item_stats
+# Fixations of words that were not fixated are missing, hence the nullable integers and floats
+WORDS_FIXATIONS_DTYPES = {'subj': 'category', 'screen': 'int16', 'line': 'int16', 'word_pos': 'int16',
+                          'trial_fix': 'Int32', 'screen_fix': 'Int32', 'duration': 'float32', 'x': 'float32'}
+WORDS_FIXATIONS_COLUMNS = list(WORDS_FIXATIONS_DTYPES)
+ITEM_STATS = ['n_subj', 'n_fix', 'n_words', 'out_of_bounds', 'return_sweeps']
 
 
-def assign_fixations_to_words(items, subjects, save_path, reprocess=False):
+def assign_fixations_to_words(items, subjects, save_path, reprocess=False, jobs=None, chunksize=1):
+    """ Each (item, subject) trial is processed as a separate task, the largest trials first.
+        The stats of the trials are then reduced by item. """
     print('Assigning fixations to words...')
-    items_stats = {}
-
-    with ProcessPoolExecutor() as executor:
-        futures = {executor.submit(process_single_item, item, subjects, reprocess, save_path):
-                       item for item in items}
-        for future in tqdm(as_completed(futures), total=len(items), desc='Processing items in parallel'):
-            item_name, item_stats = future.result()
-            items_stats[item_name] = item_stats
+    items_subjects, tasks = {}, []
+    for item in items:
+        item_savepath = save_path / item.stem
+        item_savepath.mkdir(exist_ok=True, parents=True)
+        items_subjects[item.stem] = get_subjects_to_process(subjects, item.stem, item_savepath, reprocess)
+        tasks.extend((item, subject, item_savepath) for subject in items_subjects[item.stem])
+    tasks_costs = [store.trial_size(subject / item.stem) for item, subject, _ in tasks]
+
+    trials_stats = {}
+    with ProcessPoolExecutor(jobs) as executor, tqdm(total=len(tasks), desc='Processing trials in parallel') as pbar:
+        futures = utils.submit_longest_first(executor, process_trial, tasks, tasks_costs, chunksize)
+        for future in as_completed(futures):
+            for item_name, subj_name, trial_stats in future.result():
+                trials_stats[(item_name, subj_name)] = trial_stats
+            pbar.update(len(futures[future]))
+
+    items_stats = {item_name: reduce_item_stats([trials_stats[(item_name, subj.name)] for subj in item_subjects])
+                   for item_name, item_subjects in items_subjects.items()}
     save_stats(items_stats, save_path)
 
 
-def process_item(item_name, subjects, screens_lines, item_stats, item_savepath):
-    for subject in subjects:
-        trial_path = subject / item_name
-        screen_sequence = pd.read_pickle(trial_path / 'screen_sequence.pkl')['currentscreenid'].to_numpy()
-        trial_fix_by_word = process_subj_trial(subject.name, trial_path, screen_sequence, screens_lines, item_stats)
-        trial_fix_by_word = postprocess_word_fixations(trial_fix_by_word, item_stats)
-        save_trial_word_fixations(trial_fix_by_word, item_savepath)
+def process_trial(item, subject, item_savepath):
+    screens_lines = utils.load_lines_by_screen(item)
+    trial_stats = dict.fromkeys(ITEM_STATS, 0)
+    trial_path = subject / item.stem
+    screen_sequence = utils.load_screensequence(trial_path)['currentscreenid'].to_numpy()
+    trial_fix_by_word = process_subj_trial(subject.name, trial_path, screen_sequence, screens_lines, trial_stats)
+    trial_fix_by_word = postprocess_word_fixations(trial_fix_by_word, trial_stats)
+    save_trial_word_fixations(trial_fix_by_word, item_savepath)
+    return item.stem, subject.name, trial_stats
+
+
+def reduce_item_stats(trials_stats):
+    item_stats = dict.fromkeys(ITEM_STATS, 0)
+    for trial_stats in trials_stats:
+        for stat in ITEM_STATS:
+            # The number of words is that of the item, not a count over trials
+            item_stats[stat] = trial_stats[stat] if stat == 'n_words' else item_stats[stat] + trial_stats[stat]
+    return item_stats
 
 
 def process_subj_trial(subj_name, trial_path, screen_sequence, screens_lines, item_stats):
-    # Keep track of returning screens
+    # Keep track of returning screens and of the fixations numbering of their previous visits
     screen_counter = {screen_id: 0 for screen_id in np.unique(screen_sequence)}
+    screen_offsets = {screen_id: 0 for screen_id in screen_counter}
     # Each record corresponds to a word; words with multiple fixations have multiple records.
     # Words with no fixations have NA values
-    trial_fix_by_word, total_trial_fix = [], 0
+    screens_words_fix, total_trial_fix = [], 0
     for screen_id in screen_sequence:
-        fixations, lines_pos = load_screen_data(trial_path, screen_id, screen_counter)
-        word_pos = 0
-        for line_num, line in enumerate(screens_lines[screen_id]):
-            words, spaces_pos = line['text'].split(), line['spaces_pos']
-            if line['text'][:3] == '   ':
-                spaces_pos = spaces_pos[3:]
-            line_fix = get_line_fixations(fixations, line_num, lines_pos)
-            assign_line_fixations_to_words(word_pos, line_fix, line_num, spaces_pos,
-                                           screen_id, subj_name, trial_fix_by_word)
-            word_pos += len(words)
-            total_trial_fix += len(line_fix)
+        fixations, lines_pos = load_screen_data(trial_path, screen_id, screen_counter, screen_offsets)
+        screen_words_fix, screen_lines_nfix = assign_screen_fixations(fixations, lines_pos, screens_lines[screen_id],
+                                                                      screen_id)
+        screens_words_fix.append(screen_words_fix)
+        total_trial_fix += screen_lines_nfix
 
         screen_counter[screen_id] += 1
-    trial_fix_by_word = pd.DataFrame(trial_fix_by_word,
-                                     columns=['subj', 'screen', 'line', 'word_pos', 'trial_fix',
-                                              'screen_fix', 'duration', 'x'])
+    trial_fix_by_word = words_fixations_frame(subj_name, screens_words_fix)
     update_stats(item_stats, trial_fix_by_word, total_trial_fix)
 
     return trial_fix_by_word
 
 
-def get_line_fixations(fixations, line_number, lines_pos):
-    line_fixations = fixations[fixations['yAvg'].between(lines_pos[line_number],
-                                                         lines_pos[line_number + 1],
-                                                         inclusive='left')]
-    if not line_fixations.empty:
-        # Check if first screen fixation hasn't been removed yet
-        if line_fixations.iloc[0].name == 0:
-            line_fixations = line_fixations.drop([0])
-        # Remove last fixation if it's the last fixation on the screen
-        if not line_fixations.empty and line_fixations.iloc[-1].name == len(fixations) - 1:
-            line_fixations = line_fixations.drop([len(fixations) - 1])
-
-    return line_fixations
-
-
-def assign_line_fixations_to_words(word_pos, line_fix, line_num, spaces_pos, screen_id, subj_name, trial_fix_by_word):
-    for i in range(len(spaces_pos) - 1):
-        word_fix = line_fix[line_fix['xAvg'].between(spaces_pos[i],
-                                                     spaces_pos[i + 1],
-                                                     inclusive='left')]
-        if word_fix.empty:
-            trial_fix_by_word.append([subj_name, screen_id, line_num, word_pos, None, None, None, None])
-        else:
-            word_fix = word_fix[['index', 'duration', 'xAvg']]
-            word_fix = word_fix.rename(columns={'index': 'trial_fix', 'xAvg': 'x'})
-            word_fix.reset_index(names='screen_fix', inplace=True)
-            # Shift x to start at 0
-            word_fix['x'] -= spaces_pos[i]
-            word_fix['subj'], word_fix['screen'], word_fix['line'], word_fix['word_pos'] = \
-                subj_name, screen_id, line_num, word_pos
-
-            word_fix = word_fix[['subj', 'screen', 'line', 'word_pos', 'trial_fix', 'screen_fix', 'duration', 'x']]
-            trial_fix_by_word.extend(word_fix.values.tolist())
-        word_pos += 1
+def assign_screen_fixations(fixations, lines_pos, screen_lines, screen_id):
+    """ Maps all the fixations of a screen visit to their (line, word) at once.
+        Lines are found by searching yAvg in lines_pos and words by searching xAvg in the spaces_pos of all lines,
+        concatenated and shifted by line so that they are increasing.
+        Returns one record per word fixation and one (not fixated) record per word without fixations,
+        ordered by line, word and fixation, as columns; and the number of fixations assigned to a line. """
+    lines_spaces, lines_nwords = lines_geometry(screen_lines)
+    line_fix, fix_line = line_fixations(fixations, lines_pos, len(screen_lines))
+    words_slots, fix_slots = words_slots_fixations(fixations, line_fix, fix_line, lines_spaces, lines_nwords)
+
+    # Words with no fixations take a single (empty) record
+    slots_nfix = np.bincount(fix_slots['slot'], minlength=len(words_slots['line']))
+    slots_nrecords = np.maximum(slots_nfix, 1)
+    records_slot = np.repeat(np.arange(len(slots_nrecords)), slots_nrecords)
+    slots_first_record = np.cumsum(slots_nrecords) - slots_nrecords
+    fix_order = np.argsort(fix_slots['slot'], kind='stable')
+    sorted_slots = fix_slots['slot'][fix_order]
+    fix_records = slots_first_record[sorted_slots] + np.arange(len(sorted_slots)) - \
+        np.searchsorted(sorted_slots, sorted_slots, side='left')
+
+    records_fix = np.full(len(records_slot), -1)
+    records_fix[fix_records] = fix_slots['fixation'][fix_order]
+    records_x = np.zeros(len(records_slot))
+    records_x[fix_records] = fix_slots['x'][fix_order]
+    fixated = records_fix >= 0
+    screen_words_fix = {'screen': np.full(len(records_slot), screen_id),
+                        'line': words_slots['line'][records_slot],
+                        'word_pos': words_slots['word_pos'][records_slot],
+                        'trial_fix': fixations['index'].to_numpy()[records_fix],
+                        'screen_fix': fixations.index.to_numpy()[records_fix],
+                        'duration': fixations['duration'].to_numpy()[records_fix],
+                        'x': records_x,
+                        'fixated': fixated}
+
+    return screen_words_fix, len(line_fix)
+
+
+def line_fixations(fixations, lines_pos, n_lines):
+    """ Positions of the fixations that fall within a line (i.e. lines_pos[line] <= yAvg < lines_pos[line + 1]),
+        and their line, ordered by line and then by fixation """
+    fix_line = np.searchsorted(lines_pos, fixations['yAvg'].to_numpy(dtype=float), side='right') - 1
+    fix_inline = np.flatnonzero((fix_line >= 0) & (fix_line < min(n_lines, len(lines_pos) - 1)))
+    fix_inline = fix_inline[np.argsort(fix_line[fix_inline], kind='stable')]
+    sorted_lines = fix_line[fix_inline]
+
+    # The first fixation of the screen is removed if it is the first of its line (i.e. it hasn't been removed yet),
+    # and so is the last fixation of the screen if it is the last one of its line
+    labels = fixations.index.to_numpy()[fix_inline]
+    is_first = np.diff(sorted_lines, prepend=-1) != 0
+    is_last = np.diff(sorted_lines, append=-1) != 0
+    removed = (is_first & (labels == 0)) | (is_last & (labels == len(fixations) - 1))
+
+    return fix_inline[~removed], sorted_lines[~removed]
+
+
+def lines_geometry(screen_lines):
+    """ Spaces positions and number of words of each line of a screen """
+    lines_spaces = [np.asarray(line['spaces_pos'][3:] if line['text'][:3] == '   ' else line['spaces_pos'],
+                               dtype=np.int64) for line in screen_lines]
+    lines_nwords = [len(line['text'].split()) for line in screen_lines]
+    return lines_spaces, lines_nwords
+
+
+def slots_words(lines_nslots, lines_nwords):
+    """ Line and position in the screen of the word of each slot """
+    slots_offsets = np.cumsum(lines_nslots) - lines_nslots
+    return {'line': np.repeat(np.arange(len(lines_nslots)), lines_nslots),
+            'word_pos': np.repeat(np.cumsum(lines_nwords) - lines_nwords - slots_offsets, lines_nslots)
+            + np.arange(lines_nslots.sum())}
+
+
+def words_slots_fixations(fixations, line_fix, fix_line, lines_spaces, lines_nwords):
+    """ Each word of the screen is a slot, spanning [spaces_pos[i], spaces_pos[i + 1]) in its line.
+        Spaces positions are integers, so xAvg can be floored and searched, together with its line,
+        in a single increasing array of spaces positions shifted by line. """
+    lines_nslots = np.array([len(spaces) - 1 for spaces in lines_spaces])
+    slots_offsets = np.cumsum(lines_nslots) - lines_nslots
+    # Each line has one more space than words
+    spaces_offsets = slots_offsets + np.arange(len(lines_nslots))
+    line_width = max(spaces.max() for spaces in lines_spaces) + 2
+    all_spaces = np.concatenate(lines_spaces)
+    shifted_spaces = np.concatenate([line * line_width + spaces + 1 for line, spaces in enumerate(lines_spaces)])
+    words_slots = slots_words(lines_nslots, lines_nwords)
+
+    fix_x = fixations['xAvg'].to_numpy(dtype=float)[line_fix]
+    has_x = np.isfinite(fix_x)
+    line_fix, fix_line, fix_x = line_fix[has_x], fix_line[has_x], fix_x[has_x]
+    fix_key = fix_line * line_width + np.clip(np.floor(fix_x), -1, line_width - 2).astype(np.int64) + 1
+    fix_space = np.searchsorted(shifted_spaces, fix_key, side='right') - 1
+    # The space at the left of the fixation has to be in its line and not be the last one
+    in_word = (fix_space >= spaces_offsets[fix_line]) & (fix_space < spaces_offsets[fix_line] + lines_nslots[fix_line])
+    fix_space, fix_line = fix_space[in_word], fix_line[in_word]
+    fix_slots = {'fixation': line_fix[in_word],
+                 'slot': slots_offsets[fix_line] + fix_space - spaces_offsets[fix_line],
+                 'x': fix_x[in_word] - all_spaces[fix_space]}
+
+    return words_slots, fix_slots
+
+
+def words_fixations_frame(subj_name, screens_words_fix):
+    """ Fixations columns are numeric if every word was fixated, float (with NaN) if some were not,
+        and object (with None) if none was """
+    columns = {column: np.concatenate([screen_words_fix[column] for screen_words_fix in screens_words_fix])
+               if screens_words_fix else np.array([], dtype=object)
+               for column in WORDS_FIXATIONS_COLUMNS[1:] + ['fixated']}
+    fixated = columns.pop('fixated').astype(bool)
+    for column in WORDS_FIXATIONS_COLUMNS[4:]:
+        if not fixated.any():
+            columns[column] = np.full(len(fixated), None, dtype=object)
+        elif not fixated.all():
+            columns[column] = np.where(fixated, columns[column], np.nan)
+    trial_fix_by_word = pd.DataFrame({'subj': np.full(len(fixated), subj_name, dtype=object), **columns},
+                                     columns=WORDS_FIXATIONS_COLUMNS)
+
+    return trial_fix_by_word
 
 
 def get_subjects_to_process(subjects, item_name, item_savepath, reprocess):
@@ -116,7 +207,7 @@ def get_subjects_to_process(subjects, item_name, item_savepath, reprocess):
 
 def save_trial_word_fixations(trial_fix_by_word, item_savepath):
     subj_name = trial_fix_by_word['subj'].iloc[0]
-    trial_fix_by_word.to_pickle(item_savepath / f'{subj_name}.pkl')
+    store.save_partition(item_savepath, subj_name, trial_fix_by_word)
 
 
 def save_stats(items_stats, save_path):
@@ -131,42 +222,69 @@ def save_stats(items_stats, save_path):
 
 def postprocess_word_fixations(trial_fix_by_word, item_stats):
     prev_nfix = n_fix(trial_fix_by_word)
-    trial_fix_by_word = (trial_fix_by_word.groupby(['screen', 'line'], group_keys=False)[trial_fix_by_word.columns]
-                         .apply(remove_return_sweeps_from_line))
+    trial_fix_by_word = remove_return_sweeps(trial_fix_by_word)
     item_stats['return_sweeps'] += prev_nfix - n_fix(trial_fix_by_word)
 
-    trial_fix_by_word = (trial_fix_by_word.groupby(['screen', 'word_pos'], group_keys=False)[trial_fix_by_word.columns]
-                         .apply(remove_na_from_fixated_words))
+    trial_fix_by_word = remove_na_from_fixated_words(trial_fix_by_word)
     trial_fix_by_word = make_screen_fix_consecutive(trial_fix_by_word)
-    trial_fix_by_word = cast_to_int(trial_fix_by_word)
+    trial_fix_by_word = trial_fix_by_word.astype(WORDS_FIXATIONS_DTYPES)
     trial_fix_by_word = trial_fix_by_word.sort_values(['screen', 'line', 'word_pos', 'screen_fix'])
 
     return trial_fix_by_word
 
 
-def remove_return_sweeps_from_line(line_fix):
-    # Remove fixations resulting from oculomotor errors when jumping lines
-    fst_fix_num = line_fix['screen_fix'].min()
-    first_saccade_is_regressive = is_regression(line_fix, fst_fix_num, fst_fix_num + 1)
-    if first_saccade_is_regressive:
-        first_word_with_fix = line_fix[~line_fix['screen_fix'].isna()]['word_pos'].min()
-        if not np.isnan(first_word_with_fix):
-            first_word_fix = line_fix[line_fix['word_pos'] == first_word_with_fix]
-            left_most_fix = first_word_fix[first_word_fix['x'] == first_word_fix['x'].min()]
-            line_fix.loc[line_fix['screen_fix'].between(fst_fix_num,
-                                                        left_most_fix['screen_fix'].iloc[0],
-                                                        inclusive='left'),
-                                                        ['trial_fix', 'screen_fix', 'duration', 'x']] = np.nan
+def remove_return_sweeps(trial_fix_by_word):
+    """ Remove fixations resulting from oculomotor errors when jumping lines.
+        If the first saccade in a line (i.e. from its first fixation to the following one, when both are in the line)
+        is regressive, the fixations from the first one up to the left-most fixation on the first fixated word
+        of the line are removed. All lines are handled at once, with a table of fixations indexed by line. """
+    line_keys = ['screen', 'line']
+    fixated = trial_fix_by_word[~trial_fix_by_word['screen_fix'].isna()]
+    if fixated.empty:
+        return trial_fix_by_word
+    lines_fix = fixated.drop_duplicates(line_keys + ['screen_fix']).set_index(line_keys + ['screen_fix'])
+    lines_first_fix = fixated.groupby(line_keys)['screen_fix'].min()
+    first_fix = lines_fix.reindex(pd.MultiIndex.from_arrays([lines_first_fix.index.get_level_values(0),
+                                                             lines_first_fix.index.get_level_values(1),
+                                                             lines_first_fix.to_numpy()]))
+    second_fix = lines_fix.reindex(pd.MultiIndex.from_arrays([lines_first_fix.index.get_level_values(0),
+                                                              lines_first_fix.index.get_level_values(1),
+                                                              lines_first_fix.to_numpy() + 1]))
+    first_wordpos, second_wordpos = first_fix['word_pos'].to_numpy(), second_fix['word_pos'].to_numpy()
+    first_x, second_x = first_fix['x'].to_numpy(dtype=float), second_fix['x'].to_numpy(dtype=float)
+    # Comparisons with missing (second) fixations are False
+    regressive = (first_wordpos > second_wordpos) | ((first_wordpos == second_wordpos) & (first_x > second_x))
+    if not regressive.any():
+        return trial_fix_by_word
+
+    first_word = fixated['word_pos'] == fixated.groupby(line_keys)['word_pos'].transform('min')
+    first_word_fix = fixated[first_word]
+    left_most = first_word_fix['x'] == first_word_fix.groupby(line_keys)['x'].transform('min')
+    left_most_fix = first_word_fix[left_most].groupby(line_keys)['screen_fix'].first()
+    sweeps_limits = pd.DataFrame({'sweep_start': lines_first_fix, 'sweep_end': left_most_fix})[regressive]
+    rows_limits = trial_fix_by_word[line_keys].join(sweeps_limits, on=line_keys)
+    in_sweep = ((trial_fix_by_word['screen_fix'] >= rows_limits['sweep_start']) &
+                (trial_fix_by_word['screen_fix'] < rows_limits['sweep_end'])).to_numpy()
+    if in_sweep.any():
+        fix_columns = ['trial_fix', 'screen_fix', 'duration', 'x']
+        trial_fix_by_word = trial_fix_by_word.astype({column: float for column in fix_columns})
+        trial_fix_by_word.loc[in_sweep, fix_columns] = np.nan
 
-    return line_fix
+    return trial_fix_by_word
 
 
-def remove_na_from_fixated_words(words_fix):
-    # Due to returning screens, there may be words that have fixations but were also added as empty rows
-    if n_fix(words_fix) > 0:
-        return words_fix.dropna()
-    else:
-        return words_fix.head(1)
+def remove_na_from_fixated_words(trial_fix_by_word):
+    # Due to returning screens, there may be words that have fixations but were also added as empty rows.
+    # Fixated words keep only their fixations and words without fixations keep a single row
+    word_keys = ['screen', 'word_pos']
+    is_fixated = ~trial_fix_by_word['screen_fix'].isna()
+    word_is_fixated = is_fixated.groupby([trial_fix_by_word[key] for key in word_keys]).transform('any')
+    keep = (word_is_fixated & trial_fix_by_word.notna().all(axis=1)) | \
+           (~word_is_fixated & (trial_fix_by_word.groupby(word_keys).cumcount() == 0))
+    if keep.all():
+        return trial_fix_by_word
+    # Words are grouped together when rows are removed
+    return trial_fix_by_word[keep].sort_values(word_keys, kind='stable')
 
 
 def make_screen_fix_consecutive(trial_fix_by_word):
@@ -182,18 +300,6 @@ def n_fix(df_fix):
     return len(df_fix[~df_fix['screen_fix'].isna()])
 
 
-def is_regression(df_fix, fix_num, following_fix_num):
-    regression = False
-    first_fix = df_fix[df_fix['screen_fix'] == fix_num]
-    second_fix = df_fix[df_fix['screen_fix'] == following_fix_num]
-    if not first_fix.empty and not second_fix.empty:
-        regression = first_fix['word_pos'].iloc[0] > second_fix['word_pos'].iloc[0] or \
-                     (first_fix['word_pos'].iloc[0] == second_fix['word_pos'].iloc[0] and
-                      first_fix['x'].iloc[0] > second_fix['x'].iloc[0])
-
-    return regression
-
-
 def update_stats(item_stats, trial_fix_by_word, total_trial_fix):
     item_stats['n_subj'] += 1
     item_stats['n_fix'] += n_fix(trial_fix_by_word)
@@ -201,54 +307,20 @@ def update_stats(item_stats, trial_fix_by_word, total_trial_fix):
     item_stats['out_of_bounds'] += total_trial_fix - n_fix(trial_fix_by_word)
 
 
-def cast_to_int(trial_fix_by_word):
-    for col in ['screen', 'line', 'word_pos', 'trial_fix', 'screen_fix', 'duration']:
-        trial_fix_by_word[col] = trial_fix_by_word[col].astype(pd.Int64Dtype())
-
-    return trial_fix_by_word
-
-
-def load_screen_data(trial_path, screen_id, screen_counter):
-    screen_dir = trial_path / f'screen_{screen_id}'
-    fix_filename, lines_filename = get_screen_filenames(screen_counter[screen_id])
-    fixations = load_fixations(screen_dir / fix_filename)
-    lines_pos = load_lines_pos(screen_dir / lines_filename)
+def load_screen_data(trial_path, screen_id, screen_counter, screen_offsets):
+    """ Each visit is read once: fixations of a revisited screen are numbered after the sum of the last
+        fixation index of its previous visits, which is kept in screen_offsets """
+    fixations, lines = utils.load_screen_visit(screen_id, screen_counter[screen_id], trial_path)
+    lines_pos = lines.sort_values('y')['y'].to_numpy()
 
+    last_fixation_index = fixations.iloc[-1].name
     if screen_counter[screen_id] > 0:
-        last_fixation_index = get_last_fixation_index(screen_dir, screen_counter[screen_id])
-        fixations.index += last_fixation_index + 1
+        fixations.index += screen_offsets[screen_id] + 1
+    screen_offsets[screen_id] += last_fixation_index
 
     return fixations, lines_pos
 
 
-def load_fixations(fix_file):
-    return pd.read_pickle(fix_file)
-
-
-def load_lines_pos(lines_pos_file):
-    return pd.read_pickle(lines_pos_file).sort_values('y')['y'].to_numpy()
-
-
-def get_screen_filenames(screen_times_read):
-    fix_filename = f'fixations.pkl'
-    lines_filename = f'lines.pkl'
-    if screen_times_read > 0:
-        fix_filename = f'fixations_{screen_times_read}.pkl'
-        lines_filename = f'lines_{screen_times_read}.pkl'
-
-    return fix_filename, lines_filename
-
-
-def get_last_fixation_index(screen_dir, prev_screen_times_read):
-    last_fixation_index = 0
-    for it in range(prev_screen_times_read):
-        fix_filename, _ = get_screen_filenames(it)
-        fixations = load_fixations(screen_dir / fix_filename)
-        last_fixation_index += fixations.iloc[-1].name
-
-    return last_fixation_index
-
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Assign fixations to words')
     parser.add_argument('--items_path', type=str, default='../../stimuli')
@@ -257,10 +329,12 @@ if __name__ == '__main__':
     parser.add_argument('--subj', type=str, default='all')
     parser.add_argument('--item', type=str, default='all')
     parser.add_argument('--reprocess', action='store_true')
+    parser.add_argument('--jobs', type=int, default=None, help='Number of processes (all cores by default)')
+    parser.add_argument('--chunksize', type=int, default=1, help='Number of trials sent to a process at a time')
     args = parser.parse_args()
 
     items_path, data_path, save_path = Path(args.items_path), Path(args.data_path), Path(args.save_path)
     subj_paths = [data_path / args.subj] if args.subj != 'all' else utils.get_dirs(data_path)
     items = utils.get_items(items_path, args.item)
 
-    assign_fixations_to_words(items, subj_paths, save_path, args.reprocess)
+    assign_fixations_to_words(items, subj_paths, save_path, args.reprocess, args.jobs, args.chunksize)
@@ -0,0 +1,176 @@
+from scripts.data_processing import utils
+from scripts.data_processing.assign_fix_to_words import process_subj_trial, postprocess_word_fixations, \
+    load_screen_data, update_stats, make_screen_fix_consecutive, n_fix, WORDS_FIXATIONS_COLUMNS, \
+    WORDS_FIXATIONS_DTYPES, ITEM_STATS
+from pathlib import Path
+from tqdm import tqdm
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+""" Golden-output check of the words fixations computed by assign_fix_to_words.process_subj_trial and
+    postprocessed by assign_fix_to_words.postprocess_word_fixations. The reference implementations below are the
+    original ones, which filter the fixations of each line of a screen visit with `between` and then those of each
+    of its words, appending one record per word fixation; and remove return sweeps and the empty rows of fixated
+    words with a groupby/apply by line and by word, respectively.
+    Both are run on every correct trial and the trials where their words fixations, before or after postprocessing,
+    or their stats (e.g. return_sweeps) differ are reported. """
+
+
+def check_assignment(items, subjects):
+    mismatches = []
+    with ProcessPoolExecutor() as executor:
+        futures = [executor.submit(check_item, item, subjects) for item in items]
+        for future in tqdm(as_completed(futures), total=len(futures), desc='Checking items in parallel'):
+            mismatches.extend(future.result())
+    for trial, error in sorted(mismatches):
+        print(f'{trial.parent.name}/{trial.name}: {error}')
+    print(f'{len(mismatches)} trials differ from the reference')
+    return mismatches
+
+
+def check_item(item, subjects):
+    screens_lines = utils.load_lines_by_screen(item)
+    mismatches = []
+    for subject in utils.get_correct_trials(subjects, item.stem):
+        trial_path = subject / item.stem
+        screen_sequence = utils.load_screensequence(trial_path)['currentscreenid'].to_numpy()
+        stats, ref_stats = dict.fromkeys(ITEM_STATS, 0), dict.fromkeys(ITEM_STATS, 0)
+        trial_fix_by_word = process_subj_trial(subject.name, trial_path, screen_sequence, screens_lines, stats)
+        ref_fix_by_word = reference_subj_trial(subject.name, trial_path, screen_sequence, screens_lines, ref_stats)
+        try:
+            pd.testing.assert_frame_equal(trial_fix_by_word, ref_fix_by_word)
+            assert stats == ref_stats, f'stats differ: {stats} and {ref_stats}'
+            trial_fix_by_word = postprocess_word_fixations(trial_fix_by_word, stats)
+            ref_fix_by_word = reference_postprocess(ref_fix_by_word, ref_stats)
+            pd.testing.assert_frame_equal(trial_fix_by_word, ref_fix_by_word)
+            assert stats == ref_stats, f'postprocessed stats differ: {stats} and {ref_stats}'
+        except AssertionError as error:
+            mismatches.append((trial_path, str(error).splitlines()[0]))
+    return mismatches
+
+
+def reference_subj_trial(subj_name, trial_path, screen_sequence, screens_lines, item_stats):
+    screen_counter = {screen_id: 0 for screen_id in np.unique(screen_sequence)}
+    screen_offsets = {screen_id: 0 for screen_id in screen_counter}
+    trial_fix_by_word, total_trial_fix = [], 0
+    for screen_id in screen_sequence:
+        fixations, lines_pos = load_screen_data(trial_path, screen_id, screen_counter, screen_offsets)
+        word_pos = 0
+        for line_num, line in enumerate(screens_lines[screen_id]):
+            words, spaces_pos = line['text'].split(), line['spaces_pos']
+            if line['text'][:3] == '   ':
+                spaces_pos = spaces_pos[3:]
+            line_fix = get_line_fixations(fixations, line_num, lines_pos)
+            assign_line_fixations_to_words(word_pos, line_fix, line_num, spaces_pos,
+                                           screen_id, subj_name, trial_fix_by_word)
+            word_pos += len(words)
+            total_trial_fix += len(line_fix)
+
+        screen_counter[screen_id] += 1
+    trial_fix_by_word = pd.DataFrame(trial_fix_by_word, columns=WORDS_FIXATIONS_COLUMNS)
+    update_stats(item_stats, trial_fix_by_word, total_trial_fix)
+
+    return trial_fix_by_word
+
+
+def get_line_fixations(fixations, line_number, lines_pos):
+    line_fixations = fixations[fixations['yAvg'].between(lines_pos[line_number],
+                                                         lines_pos[line_number + 1],
+                                                         inclusive='left')]
+    if not line_fixations.empty:
+        # Check if first screen fixation hasn't been removed yet
+        if line_fixations.iloc[0].name == 0:
+            line_fixations = line_fixations.drop([0])
+        # Remove last fixation if it's the last fixation on the screen
+        if not line_fixations.empty and line_fixations.iloc[-1].name == len(fixations) - 1:
+            line_fixations = line_fixations.drop([len(fixations) - 1])
+
+    return line_fixations
+
+
+def assign_line_fixations_to_words(word_pos, line_fix, line_num, spaces_pos, screen_id, subj_name, trial_fix_by_word):
+    for i in range(len(spaces_pos) - 1):
+        word_fix = line_fix[line_fix['xAvg'].between(spaces_pos[i],
+                                                     spaces_pos[i + 1],
+                                                     inclusive='left')]
+        if word_fix.empty:
+            trial_fix_by_word.append([subj_name, screen_id, line_num, word_pos, None, None, None, None])
+        else:
+            word_fix = word_fix[['index', 'duration', 'xAvg']]
+            word_fix = word_fix.rename(columns={'index': 'trial_fix', 'xAvg': 'x'})
+            word_fix.reset_index(names='screen_fix', inplace=True)
+            # Shift x to start at 0
+            word_fix['x'] -= spaces_pos[i]
+            word_fix['subj'], word_fix['screen'], word_fix['line'], word_fix['word_pos'] = \
+                subj_name, screen_id, line_num, word_pos
+
+            word_fix = word_fix[WORDS_FIXATIONS_COLUMNS]
+            trial_fix_by_word.extend(word_fix.values.tolist())
+        word_pos += 1
+
+
+def reference_postprocess(trial_fix_by_word, item_stats):
+    prev_nfix = n_fix(trial_fix_by_word)
+    trial_fix_by_word = (trial_fix_by_word.groupby(['screen', 'line'], group_keys=False)[trial_fix_by_word.columns]
+                         .apply(remove_return_sweeps_from_line))
+    item_stats['return_sweeps'] += prev_nfix - n_fix(trial_fix_by_word)
+
+    trial_fix_by_word = (trial_fix_by_word.groupby(['screen', 'word_pos'], group_keys=False)[trial_fix_by_word.columns]
+                         .apply(remove_na_from_fixated_words))
+    trial_fix_by_word = make_screen_fix_consecutive(trial_fix_by_word)
+    trial_fix_by_word = trial_fix_by_word.astype(WORDS_FIXATIONS_DTYPES)
+    trial_fix_by_word = trial_fix_by_word.sort_values(['screen', 'line', 'word_pos', 'screen_fix'])
+
+    return trial_fix_by_word
+
+
+def remove_return_sweeps_from_line(line_fix):
+    # Remove fixations resulting from oculomotor errors when jumping lines
+    fst_fix_num = line_fix['screen_fix'].min()
+    first_saccade_is_regressive = is_regression(line_fix, fst_fix_num, fst_fix_num + 1)
+    if first_saccade_is_regressive:
+        first_word_with_fix = line_fix[~line_fix['screen_fix'].isna()]['word_pos'].min()
+        if not np.isnan(first_word_with_fix):
+            first_word_fix = line_fix[line_fix['word_pos'] == first_word_with_fix]
+            left_most_fix = first_word_fix[first_word_fix['x'] == first_word_fix['x'].min()]
+            line_fix.loc[line_fix['screen_fix'].between(fst_fix_num,
+                                                        left_most_fix['screen_fix'].iloc[0],
+                                                        inclusive='left'),
+                                                        ['trial_fix', 'screen_fix', 'duration', 'x']] = np.nan
+
+    return line_fix
+
+
+def remove_na_from_fixated_words(words_fix):
+    # Due to returning screens, there may be words that have fixations but were also added as empty rows
+    if n_fix(words_fix) > 0:
+        return words_fix.dropna()
+    else:
+        return words_fix.head(1)
+
+
+def is_regression(df_fix, fix_num, following_fix_num):
+    regression = False
+    first_fix = df_fix[df_fix['screen_fix'] == fix_num]
+    second_fix = df_fix[df_fix['screen_fix'] == following_fix_num]
+    if not first_fix.empty and not second_fix.empty:
+        regression = first_fix['word_pos'].iloc[0] > second_fix['word_pos'].iloc[0] or \
+                     (first_fix['word_pos'].iloc[0] == second_fix['word_pos'].iloc[0] and
+                      first_fix['x'].iloc[0] > second_fix['x'].iloc[0])
+
+    return regression
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the fixations assignment against the reference implementation')
+    parser.add_argument('--items_path', type=str, default='../../stimuli')
+    parser.add_argument('--data_path', type=str, default='../../data/processed/trials')
+    parser.add_argument('--subj', type=str, default='all')
+    parser.add_argument('--item', type=str, default='all')
+    args = parser.parse_args()
+
+    items_path, data_path = Path(args.items_path), Path(args.data_path)
+    subj_paths = [data_path / args.subj] if args.subj != 'all' else utils.get_dirs(data_path)
+    check_assignment(utils.get_items(items_path, args.item), subj_paths)
@@ -0,0 +1,206 @@
+from scripts.data_processing import utils, store
+from scripts.data_processing.extract_measures import trial_measures, item_words, add_words_to_list, \
+    should_exclude_word, is_end_of_sentence, build_scanpaths, divide_into_words, CHARS_MAP, MEASURES_DTYPES
+from pathlib import Path
+from tqdm import tqdm
+import argparse
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+""" Golden-output check of the measures computed by extract_measures.trial_measures and of the scanpaths built by
+    extract_measures.build_scanpaths. The reference implementations below are the original ones, which compute
+    the measures of each word separately by filtering the fixations of its screen, and build the scanpath of each
+    subject separately. Both are run on every trial of the words fixations dataset and the trials where their
+    measures or scanpath fixations differ are reported, as well as the items where their scanpaths differ. """
+
+WORDS_FIX_DTYPES = {'subj': str, 'fix_idx': float, 'fix_duration': float, 'word_idx': int}
+
+
+def check_measures(items_wordsfix, items_path, chars_mapping):
+    mismatches = []
+    with ProcessPoolExecutor() as executor:
+        futures = [executor.submit(check_item, item, items_path, chars_mapping) for item in items_wordsfix]
+        for future in tqdm(as_completed(futures), total=len(futures), desc='Checking items in parallel'):
+            mismatches.extend(future.result())
+    for trial, error in sorted(mismatches):
+        print(f'{trial.parent.name}/{trial.stem}: {error}')
+    print(f'{len(mismatches)} trials differ from the reference')
+    return mismatches
+
+
+def check_item(item, items_path, chars_mapping):
+    screens_text = utils.load_lines_text_by_screen(item.name, items_path)
+    words = item_words(utils.load_lines_by_screen(items_path / f'{item.name}.mat'), chars_mapping)
+    mismatches, items_words_fix = [], []
+    for trial in store.item_partitions(item):
+        trial_df = store.load_partition(trial)
+        measures, words_fix = trial_measures(trial_df, words)
+        ref_measures, ref_words_fix = reference_measures(trial_df, screens_text, chars_mapping)
+        items_words_fix.append(words_fix)
+        try:
+            pd.testing.assert_frame_equal(measures.astype(MEASURES_DTYPES), ref_measures.astype(MEASURES_DTYPES),
+                                          check_categorical=False)
+            pd.testing.assert_frame_equal(words_fix.astype(WORDS_FIX_DTYPES), ref_words_fix.astype(WORDS_FIX_DTYPES))
+        except AssertionError as error:
+            mismatches.append((trial, str(error).splitlines()[0]))
+    if items_words_fix:
+        words_fix = pd.concat(items_words_fix, ignore_index=True).sort_values(['subj', 'fix_idx'])
+        if build_scanpaths(words_fix, screens_text, chars_mapping) != \
+                reference_scanpaths(words_fix, screens_text, chars_mapping):
+            mismatches.append((item / 'scanpaths', 'scanpaths differ'))
+    return mismatches
+
+
+def reference_measures(trial, screens_text, chars_mapping):
+    measures, words_fix = [], []
+    add_trial_measures(trial, screens_text, chars_mapping, measures, words_fix)
+    measures = pd.DataFrame(measures, columns=list(MEASURES_DTYPES))
+    words_fix = pd.DataFrame(words_fix, columns=list(WORDS_FIX_DTYPES))
+    return measures, words_fix
+
+
+def reference_scanpaths(words_fix, screens_text, chars_mapping):
+    item_text, item_sentences_ids = divide_into_words(screens_text)
+    item_text = pd.DataFrame({'word': item_text, 'sentence_id': item_sentences_ids})
+    scanpaths_text = {}
+    for subj in words_fix['subj'].unique():
+        subj_fix = words_fix[words_fix['subj'] == subj]
+        subj_scanpath_df = item_text.iloc[subj_fix['word_idx']]
+        subj_scanpath = subj_scanpath_df['word'].tolist()
+        sentences_ids = subj_scanpath_df['sentence_id'].tolist()
+        subj_scanpath = parse_sentences(subj_scanpath, sentences_ids, chars_mapping)
+        scanpaths_text[subj] = {'words': subj_scanpath, 'words_ids': subj_fix['word_idx'].tolist()}
+    return scanpaths_text
+
+
+def parse_sentences(subj_scanpath, sentences_ids, chars_mapping):
+    curr_sentence_id = 0
+    for i, word in enumerate(subj_scanpath[:-1]):
+        next_word, next_sentence_id = subj_scanpath[i + 1], sentences_ids[i + 1]
+        word = word.replace('.', '')
+        word = word if word != next_word else word.translate(chars_mapping)
+        subj_scanpath[i] = word if curr_sentence_id == next_sentence_id else word.translate(chars_mapping) + '.'
+        curr_sentence_id = next_sentence_id
+    return subj_scanpath
+
+
+def add_trial_measures(trial, screens_text, chars_mapping, measures, words_fix):
+    word_idx, sentence_idx, sentence_pos = 0, 0, 0
+    for screen in screens_text:
+        screen_words = []
+        add_words_to_list(screens_text[screen], screen_words)
+        screen_fix = trial[trial['screen'] == int(screen)]
+        if screen_fix.empty:
+            continue
+        for word_pos, word in enumerate(screen_words):
+            prev_word = screen_words[word_pos - 1] if word_pos > 0 else ''
+            clean_word = word.lower().translate(chars_mapping)
+            exclude = should_exclude_word(prev_word, word, clean_word, word_pos, line_num_words(word_pos, screen_fix))
+
+            word_fix = screen_fix[screen_fix['word_pos'] == word_pos]
+            add_word_fixations(word_fix, word_idx, words_fix)
+            add_word_measures(word_idx, clean_word, sentence_idx, sentence_pos, word_pos, exclude, word_fix,
+                              screen_fix, measures)
+            sentence_pos = sentence_pos + 1 if not is_end_of_sentence(word) else 0
+            sentence_idx = sentence_idx if not is_end_of_sentence(word) else sentence_idx + 1
+            word_idx += 1
+
+
+def add_word_fixations(word_fix, word_idx, words_fix):
+    if not has_no_fixations(word_fix):
+        words_fix.extend([word_fix['subj'].iloc[0], fix_idx, fix_duration, word_idx]
+                         for fix_idx, fix_duration in zip(word_fix['trial_fix'], word_fix['duration']))
+
+
+def add_word_measures(word_idx, clean_word, sentence_idx, sentence_pos, screen_pos, exclude, word_fix, screen_fix,
+                      measures):
+    subj_name, screen, word_pos = word_fix['subj'].iloc[0], word_fix['screen'].iloc[0], word_fix['word_pos'].iloc[0]
+    if has_no_fixations(word_fix) or exclude:
+        measures.append([subj_name, screen, word_idx, clean_word, sentence_idx, sentence_pos, screen_pos, exclude,
+                         0, 0, 0, 0, 0, 0, 0, 0, 0])
+    else:
+        following_words_fix = screen_fix[screen_fix['word_pos'] > word_pos].dropna()
+        prev_words_fix = screen_fix[screen_fix['word_pos'] < word_pos].dropna()
+        ffd, sfd, fprt, rpd, tfd, rrt, sprt, fc, rc = word_measures(word_fix, prev_words_fix, following_words_fix)
+        measures.append([subj_name, screen, word_idx, clean_word, sentence_idx, sentence_pos, screen_pos, exclude,
+                         ffd, sfd, fprt, rpd, tfd, rrt, sprt, fc, rc])
+
+
+def word_measures(word_fix, prev_words_fix, following_words_fix):
+    n_first_pass_fix = first_pass_n_fix(word_fix, following_words_fix)
+    last_fix_before_exiting = last_fix_before_exiting_to_the_right(word_fix, following_words_fix)
+    regressions_to_prev = regressions_to_previous_words(word_fix, prev_words_fix, last_fix_before_exiting)
+    fix_dur_before_exiting_to_the_right = word_fix['duration'].loc[:last_fix_before_exiting].sum() \
+        if last_fix_before_exiting != -1 else 0
+    ffd = word_fix['duration'].iloc[0] if n_first_pass_fix > 0 else 0
+    sfd = ffd if len(word_fix['screen_fix']) == 1 else 0
+    fprt = word_fix['duration'][:n_first_pass_fix].sum()
+    rpd = regressions_to_prev + fix_dur_before_exiting_to_the_right
+    tfd = word_fix['duration'].sum()
+    rrt = rpd - fprt
+    sprt = tfd - fprt
+    fc = len(word_fix['screen_fix'])
+    rc = fc - n_first_pass_fix
+    return ffd, sfd, fprt, rpd, tfd, rrt, sprt, fc, rc
+
+
+def first_pass_n_fix(word_fix, following_words_fix):
+    # Count number of first pass reading fixations on word
+    fst_fix = word_fix['screen_fix'].iloc[0]
+    regressive_saccade = (following_words_fix['screen_fix'] < fst_fix).values.any()
+    if regressive_saccade:
+        # Word was first skipped and then fixated (i.e., right-to-left saccade)
+        return 0
+    else:
+        # This disregards intra-word regressions; inter-word regressions (rightward or leftward) are considered
+        return n_consecutive_fix(word_fix['screen_fix'])
+
+
+def last_fix_before_exiting_to_the_right(word_fix, following_words_fix):
+    first_fix_to_the_right = following_words_fix['screen_fix'].min()
+    fixs_before_exiting_to_the_right = word_fix[word_fix['screen_fix'] < first_fix_to_the_right]['screen_fix']
+    if not fixs_before_exiting_to_the_right.empty:
+        last_fix_idx = fixs_before_exiting_to_the_right.idxmax()
+    else:
+        last_fix_idx = -1
+    return last_fix_idx
+
+
+def regressions_to_previous_words(word_fix, prev_words_fix, last_fix_before_exiting):
+    return prev_words_fix[(prev_words_fix['screen_fix'] > word_fix['screen_fix'].iloc[0]) &
+                          (prev_words_fix['screen_fix'] < last_fix_before_exiting)]['duration'].sum()
+
+
+def n_consecutive_fix(fix_indices):
+    fix_counter = 1
+    for i, fix_idx in enumerate(fix_indices[:-1]):
+        if fix_idx != fix_indices.iloc[i + 1] - 1:
+            break
+        fix_counter += 1
+
+    return fix_counter
+
+
+def line_num_words(word_pos, screen_fix):
+    line_num = screen_fix[screen_fix['word_pos'] == word_pos]['line'].iloc[0]
+    line_nwords = screen_fix[screen_fix['line'] == line_num]['word_pos'].max()
+
+    return line_nwords
+
+
+def has_no_fixations(word_fix):
+    return word_fix['trial_fix'].isna().all()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the measures engine against the reference implementation')
+    parser.add_argument('--data_path', type=str, default='../../data/processed/words_fixations',
+                        help='Where items\' fixations by word are stored')
+    parser.add_argument('--items_path', type=str, default='../../stimuli',
+                        help='Items path, from which the stimuli (items\' text) is extracted')
+    parser.add_argument('--item', type=str, default='all')
+    args = parser.parse_args()
+
+    data_path, items_path = Path(args.data_path), Path(args.items_path)
+    items_wordsfix = [data_path / args.item] if args.item != 'all' else utils.get_dirs(data_path)
+    check_measures(items_wordsfix, items_path, str.maketrans(CHARS_MAP))
@@ -1,10 +1,28 @@
 import numpy as np
 import pandas as pd
-import regex as re
 import time
+import json
+import shutil
+from array import array
+from pathlib import Path
 
 
-def parse_asc(filename, verbose=True):
+# Columns read from each event line, starting at the token that follows the line type
+EVENTS_COLUMNS = {'START': ['tStart'],
+                  'END': ['tEnd', None, None, None, 'xRes', 'yRes'],
+                  'EFIX': ['eye', 'tStart', 'tEnd', 'duration', 'xAvg', 'yAvg', 'pupilAvg'],
+                  'ESACC': ['eye', 'tStart', 'tEnd', 'duration', 'xStart', 'yStart', 'xEnd', 'yEnd', 'ampDeg', 'vPeak'],
+                  'EBLINK': ['eye', 'tStart', 'tEnd', 'duration']}
+SAMPLES_COLUMNS = ['tSample', 'LX', 'LY', 'LPupil', 'RX', 'RY', 'RPupil']
+RECORDS = {'MSG', 'SAMPLE', *EVENTS_COLUMNS}
+# Dataframes returned by parse_asc, in order, and the record types each one is built from
+FRAMES_RECORDS = {'rec': {'START', 'END'}, 'msg': {'MSG'}, 'fix': {'EFIX'}, 'sacc': {'ESACC'},
+                  'blink': {'EBLINK'}, 'samples': {'SAMPLE'}}
+# Bump whenever parse_asc output changes, so that cached files are parsed again
+PARSER_VERSION = 3
+
+
+def parse_asc(filename, records=None, verbose=True):
     """Reads in .asc data files from EyeLink and produces pandas dataframes for further analysis
     
     Created 7/31/18-8/15/18 by DJ.
@@ -14,6 +32,8 @@ def parse_asc(filename, verbose=True):
     
     INPUTS:
     -filename is a string indicating an EyeLink data file from an AX-CPT task in the current path.
+    -records is an optional subset of RECORDS (e.g. {'MSG', 'EFIX'}). Lines of any other type are skipped
+    at read time and their dataframes are returned empty.
     
     OUTPUTS:
     -df_rec contains information about recording periods (often trials)
@@ -26,141 +46,276 @@ def parse_asc(filename, verbose=True):
     Created 7/31/18-8/15/18 by DJ.
     Updated 11/12/18 by DJ - switched from "trials" to "recording periods" for experiments with continuous recording
     Modified by Gustavo Juantorena (github.com/gej1) 06/01/22
+    Rewritten as a single-pass streaming parser: the file is read once and each record type is
+    appended to its own column buffers, instead of re-reading it with pd.read_csv for every type.
     """
+    records = RECORDS if records is None else set(records)
+    unknown_records = records - RECORDS
+    if unknown_records:
+        raise ValueError('unknown record types: ' + ', '.join(sorted(unknown_records)))
+    parse_samples = 'SAMPLE' in records
     if verbose:
         print('Parsing EyeLink ASCII file %s...' % str(filename))
     t0 = time.time()
-    with filename.open('r') as fp:
-        file_txt0 = fp.read().splitlines(keepends=True)
-
-    file_txt0 = list(filter(None, file_txt0))
-    file_txt0 = np.array(file_txt0)
-
-    # Separate lines into samples and messages
-    n_lines = len(file_txt0)
-    line_type = np.array(['OTHER'] * n_lines, dtype='object')
-    i_start_rec = None
-    for iLine in range(n_lines):
-        if len(file_txt0[iLine]) < 3:
-            line_type[iLine] = 'EMPTY'
-        elif file_txt0[iLine].startswith('*') or file_txt0[iLine].startswith('>>>>>'):
-            line_type[iLine] = 'COMMENT'
-        elif file_txt0[iLine].split()[0][0].isdigit() or file_txt0[iLine].split()[0].startswith('-'):
-            line_type[iLine] = 'SAMPLE'
-        else:
-            line_type[iLine] = file_txt0[iLine].split()[0]
-        if '!CAL' in file_txt0[iLine]:
-            i_start_rec = iLine + 1
-
-            # ===== PARSE EYELINK FILE ===== #
-    i_not_start = np.nonzero(line_type != 'START')[0]
-    df_rec_start = pd.read_csv(filename, skiprows=i_not_start, header=None, sep='\\s+', usecols=[1],
-                               low_memory=False)
-    df_rec_start.columns = ['tStart']
-    i_not_end = np.nonzero(line_type != 'END')[0]
-    df_rec_end = pd.read_csv(filename, skiprows=i_not_end, header=None, sep='\\s+', usecols=[1, 5, 6],
-                             low_memory=False)
-    df_rec_end.columns = ['tEnd', 'xRes', 'yRes']
-    # combine trial info
-    df_rec = pd.concat([df_rec_start, df_rec_end], axis=1)
-    n_rec = df_rec.shape[0]
+    events = {line_type: {col: [] for col in cols if col} for line_type, cols in EVENTS_COLUMNS.items()}
+    t_msg, txt_msg = [], []
+    samples = [array('d') for _ in SAMPLES_COLUMNS]
+    samples_width, recorded_eyes = len(SAMPLES_COLUMNS), set()
+    # Samples are only kept after the last calibration, so there are none if the file has no calibration
+    calibrated = False
+    with Path(filename).open('r') as fp:
+        for line in fp:
+            if len(line) < 3:
+                continue
+            # Samples make up most of the file: discard them before splitting the line if not requested
+            if is_sample(line):
+                if parse_samples and calibrated:
+                    add_sample(line.split(), samples, samples_width)
+                continue
+            tokens = line.split()
+            if not tokens:
+                continue
+            first_token = tokens[0]
+            if is_sample(first_token):
+                if parse_samples and calibrated:
+                    add_sample(tokens, samples, samples_width)
+                continue
+            if parse_samples and '!CAL' in line:
+                samples, calibrated = [array('d') for _ in SAMPLES_COLUMNS], True
+            if first_token == 'START':
+                samples_width, recorded_eyes = recording_eyes(tokens, recorded_eyes)
+            if line[0] == '*' or line.startswith('>>>>>') or first_token not in records:
+                continue
+            if first_token == 'MSG':
+                # separate MSG prefix and timestamp from rest of message
+                t_msg.append(int(tokens[1]))
+                txt_msg.append(' '.join(tokens[2:]))
+            elif first_token in events:
+                add_event(tokens, EVENTS_COLUMNS[first_token], events[first_token])
 
-    # Import Messages
-    t = time.time()
-    i_msg = np.nonzero(line_type == 'MSG')[0]
-    t_msg = []
-    txt_msg = []
-    for i in range(len(i_msg)):
-        # separate MSG prefix and timestamp from rest of message
-        info = file_txt0[i_msg[i]].split()
-        # extract info
-        t_msg.append(int(info[1]))
-        txt_msg.append(' '.join(info[2:]))
-    df_msg = pd.DataFrame({'time': t_msg, 'text': txt_msg})
-
-    # Import Fixations
-    i_not_efix = np.nonzero(line_type != 'EFIX')[0]
-    df_fix = pd.read_csv(filename, skiprows=i_not_efix, header=None, sep='\\s+', usecols=range(1, 8),
-                         low_memory=False)
-    df_fix.columns = ['eye', 'tStart', 'tEnd', 'duration', 'xAvg', 'yAvg', 'pupilAvg']
-
-    # Saccades
-    i_not_esacc = np.nonzero(line_type != 'ESACC')[0]
-    df_sacc = pd.read_csv(filename, skiprows=i_not_esacc, header=None, sep='\\s+', usecols=range(1, 11),
-                          low_memory=False)
-    df_sacc.columns = ['eye', 'tStart', 'tEnd', 'duration', 'xStart', 'yStart', 'xEnd', 'yEnd', 'ampDeg', 'vPeak']
-
-    # Blinks
-    df_blink = pd.DataFrame()
-    i_not_eblink = np.nonzero(line_type != 'EBLINK')[0]
-    if len(i_not_eblink) < n_lines:
-        df_blink = pd.read_csv(filename, skiprows=i_not_eblink, header=None, sep='\\s+', usecols=range(1, 5),
-                               low_memory=False)
-        df_blink.columns = ['eye', 'tStart', 'tEnd', 'duration']
+    # ===== BUILD DATAFRAMES ===== #
+    df_rec = pd.concat([events_dataframe(events['START']), events_dataframe(events['END'])], axis=1)
+    n_rec = df_rec.shape[0]
+    df_msg = pd.DataFrame({'time': np.array(t_msg, dtype=np.int64), 'text': txt_msg})
+    df_fix = events_dataframe(events['EFIX'])
+    df_sacc = events_dataframe(events['ESACC'])
+    df_blink = events_dataframe(events['EBLINK']) if events['EBLINK']['eye'] else pd.DataFrame()
 
     # determine sample columns based on eyes recorded in file
-    eyes_in_file = np.unique(df_fix.eye)
-    if eyes_in_file.size == 2:
-        cols = ['tSample', 'LX', 'LY', 'LPupil', 'RX', 'RY', 'RPupil']
-    else:
-        eye = eyes_in_file[0]
-        print('monocular data detected (%c eye).' % eye)
-        cols = ['tSample', '%cX' % eye, '%cY' % eye, '%cPupil' % eye]
-
-    # Import samples
+    eyes_in_file = np.unique(df_fix.eye) if 'EFIX' in records else np.array(sorted(recorded_eyes))
+    if eyes_in_file.size == 1:
+        print('monocular data detected (%c eye).' % eyes_in_file[0])
     df_samples = pd.DataFrame()
-    if i_start_rec:
-        i_not_sample = np.nonzero(np.logical_or(line_type != 'SAMPLE', np.arange(n_lines) < i_start_rec))[0]
-        df_samples = pd.read_csv(filename, skiprows=i_not_sample, header=None, sep='\\s+', usecols=range(0, len(cols)),
-                                 low_memory=False)
-        df_samples.columns = cols
-        # Convert values to numbers
-        for eye in ['L', 'R']:
-            if eye in eyes_in_file:
-                df_samples['%cX' % eye] = pd.to_numeric(df_samples['%cX' % eye], errors='coerce')
-                df_samples['%cY' % eye] = pd.to_numeric(df_samples['%cY' % eye], errors='coerce')
-                df_samples['%cPupil' % eye] = pd.to_numeric(df_samples['%cPupil' % eye], errors='coerce')
-            else:
-                df_samples['%cX' % eye] = np.nan
-                df_samples['%cY' % eye] = np.nan
-                df_samples['%cPupil' % eye] = np.nan
+    if len(samples[0]):
+        df_samples = samples_dataframe(samples, eyes_in_file)
 
     if verbose:
         print('%d recording periods found.' % n_rec)
-        print(f'{len(i_msg)} messages')
+        print(f'{len(t_msg)} messages')
         print(f'{df_fix.shape[0]} fixations')
         print(f'{df_sacc.shape[0]} saccades')
         print(f'{df_blink.shape[0]} blinks')
         print(f'{df_samples.shape[0]} samples')
         if eyes_in_file.size == 2:
             print('binocular data detected.')
-        else:
+        elif eyes_in_file.size == 1:
             print('monocular data detected (%c eye).' % eyes_in_file[0])
         print('Done! Took %.1f seconds.' % (time.time() - t0))
 
     return df_rec, df_msg, df_fix, df_sacc, df_blink, df_samples
 
 
+def load_asc(filename, cache_path, records=None, verbose=True):
+    """ Same output as parse_asc, but parsed records are cached in cache_path (one .npy file per column,
+        which can be memory-mapped). The cache is reused as long as the .asc file (size and modification time)
+        and PARSER_VERSION are unchanged, and it is extended when records that were not cached are requested. """
+    filename = Path(filename)
+    records = RECORDS if records is None else set(records)
+    file_cache = Path(cache_path) / filename.stem
+    file_key = asc_cache_key(filename)
+    cached_meta = load_cache_meta(file_cache)
+    cached_records = set()
+    if cached_meta and cached_meta['key'] == file_key:
+        cached_records = set(cached_meta['records'])
+        if records <= cached_records:
+            if verbose:
+                print('Loading parsed EyeLink ASCII file %s from cache...' % str(filename))
+            return load_cached_frames(file_cache, cached_meta, records)
+
+    parsed_records = records | cached_records
+    frames = parse_asc(filename, records=parsed_records, verbose=verbose)
+    save_cached_frames(file_cache, file_key, parsed_records, frames)
+    return tuple(frame if FRAMES_RECORDS[name] & records else frame.iloc[:0]
+                 for name, frame in zip(FRAMES_RECORDS, frames))
+
+
+def asc_cache_key(filename):
+    file_stat = filename.stat()
+    return {'parser_version': PARSER_VERSION, 'size': file_stat.st_size, 'mtime_ns': file_stat.st_mtime_ns}
+
+
+def load_cache_meta(file_cache):
+    meta_file = file_cache / 'meta.json'
+    if not meta_file.exists():
+        return None
+    with meta_file.open('r') as f:
+        return json.load(f)
+
+
+def load_cached_frames(file_cache, meta, records):
+    frames = []
+    for name in FRAMES_RECORDS:
+        columns = meta['columns'][name]
+        if FRAMES_RECORDS[name] & records:
+            # Not copied (nor consolidated into a single block), so that the columns stay memory-mapped
+            frame = pd.DataFrame({col: np.load(file_cache / f'{name}.{col}.npy', mmap_mode='r') for col in columns},
+                                 copy=False)
+        else:
+            frame = pd.DataFrame(columns=columns)
+        frames.append(frame)
+    return tuple(frames)
+
+
+def save_cached_frames(file_cache, file_key, records, frames):
+    if file_cache.exists():
+        shutil.rmtree(file_cache)
+    file_cache.mkdir(parents=True)
+    columns = {}
+    for name, frame in zip(FRAMES_RECORDS, frames):
+        columns[name] = frame.columns.to_list()
+        for col in columns[name]:
+            values = frame[col].to_numpy()
+            if values.dtype == object:
+                values = values.astype(str)
+            np.save(file_cache / f'{name}.{col}.npy', values)
+    # Written last: a cache without metadata is incomplete and gets discarded
+    with (file_cache / 'meta.json').open('w') as f:
+        json.dump({'key': file_key, 'records': sorted(records), 'columns': columns}, f)
+
+
+def is_sample(line):
+    return line[0].isdigit() or line[0] == '-'
+
+
+def recording_eyes(start_tokens, recorded_eyes):
+    start_eyes = {eye[0] for eye in start_tokens if eye in ('LEFT', 'RIGHT')}
+    samples_width = 7 if len(start_eyes) == 2 else 4
+    return samples_width, recorded_eyes | start_eyes
+
+
+def add_event(tokens, columns, buffers):
+    for col, token in zip(columns, tokens[1:]):
+        if col:
+            buffers[col].append(token)
+
+
+def add_sample(tokens, samples, samples_width):
+    # Timestamps are fractional when sampling at 2000 Hz (e.g. 1234567.5)
+    samples[0].append(float(tokens[0]))
+    for i in range(1, len(SAMPLES_COLUMNS)):
+        if i < samples_width and i < len(tokens):
+            samples[i].append(to_float(tokens[i]))
+        else:
+            samples[i].append(np.nan)
+
+
+def to_float(token):
+    try:
+        return float(token)
+    except ValueError:
+        # Missing data (e.g. '.' during blinks)
+        return np.nan
+
+
+def events_dataframe(buffers):
+    df_events = pd.DataFrame({col: pd.to_numeric(values, errors='coerce') if col != 'eye' else values
+                              for col, values in buffers.items()})
+    return df_events
+
+
+def samples_dataframe(samples, eyes_in_file):
+    if eyes_in_file.size == 2:
+        cols = SAMPLES_COLUMNS
+    else:
+        eye = eyes_in_file[0]
+        cols = ['tSample', '%cX' % eye, '%cY' % eye, '%cPupil' % eye]
+    df_samples = pd.DataFrame({col: np.frombuffer(samples[i], dtype=samples[i].typecode)
+                               for i, col in enumerate(cols)})
+    if np.all(np.mod(df_samples['tSample'], 1) == 0):
+        df_samples['tSample'] = df_samples['tSample'].astype(np.int64)
+    for eye in ['L', 'R']:
+        if eye not in eyes_in_file:
+            df_samples['%cX' % eye] = np.nan
+            df_samples['%cY' % eye] = np.nan
+            df_samples['%cPupil' % eye] = np.nan
+
+    return df_samples
+
+
+# Kinds of messages, by priority, and the pattern that identifies each of them
+MESSAGES_KINDS = {'cal_validation': r'CAL VALIDATION',
+                  'cal_points': r'Calibration points',
+                  'cal_point': r'^!CAL\s+-?\d+(?:\.\d+)?,?\s+-?\d+(?:\.\d+)?',
+                  'validate': r'VALIDATE',
+                  'manual_validation': r'validation|pseudocalib',
+                  'end_experiment': r'termina experimento',
+                  'screen_ini': r'^ini\s+\d+\s+\d+',
+                  'screen_fin': r'^fin\s+\d+\s+\d+'}
+
+
+def parse_messages(df_msg):
+    """ Parses every message into a typed table, keeping the original time and text columns:
+        -kind: one of MESSAGES_KINDS (or 'other')
+        -eye: 'L' or 'R' for calibration/validation messages that refer to an eye
+        -x, y: calibration point, validation point or manual validation point coordinates
+        -offset_x, offset_y: validation offset, in pixels
+        -error: average calibration validation error
+        -aborted: whether a calibration validation was aborted
+        -screen: screen id of screen changes messages ('ini' and 'fin') """
+    if 'kind' in df_msg:
+        return df_msg
+    text = df_msg['text']
+    messages = df_msg[['time', 'text']].copy()
+    kinds_masks = [text.str.contains(pattern, regex=True) for pattern in MESSAGES_KINDS.values()]
+    messages['kind'] = np.select(kinds_masks, list(MESSAGES_KINDS), default='other')
+    messages['eye'] = text.str.extract(r'\b(LEFT|RIGHT)\b', expand=False).str[0]
+
+    kind = messages['kind']
+    cal_point = text.str.extract(r'^!CAL\s+(-?\d+(?:\.\d+)?),?\s+(-?\d+(?:\.\d+)?)').astype(float)
+    val_point = text.str.extract(r'at\s*(-?\d+)\s*,\s*(-?\d+)').astype(float)
+    manualval_point = text.str.extract(r'(\d+),(\d+)').astype(float)
+    for col in [0, 1]:
+        messages['xy'[col]] = np.select([kind == 'cal_point', kind == 'validate', kind == 'manual_validation'],
+                                        [cal_point[col], val_point[col], manualval_point[col]], default=np.nan)
+    offsets = text.str.extract(r'OFFSET.*?(-?\d+\.\d+)\s*,\s*(-?\d+\.\d+)\s*pix').astype(float)
+    messages['offset_x'] = offsets[0].where(kind == 'validate')
+    messages['offset_y'] = offsets[1].where(kind == 'validate')
+    messages['error'] = text.str.extract(r'ERROR\s+(-?\d+(?:\.\d+)?)', expand=False).astype(float)
+    messages['aborted'] = text.str.contains('ABORTED')
+    screen = text.str.extract(r'^(?:ini|fin)\s+\d+\s+(\d+)', expand=False).astype(float)
+    messages['screen'] = screen.where(kind.isin(['screen_ini', 'screen_fin']))
+
+    return messages
+
+
 def find_besteye(df_msg, default='R'):
-    val_msgs = (df_msg[df_msg['text'].str.contains('CAL VALIDATION')][-2:]).to_numpy(dtype=str)
-    if not len(val_msgs) or 'ABORTED' in val_msgs[0][1]:
+    df_msg = parse_messages(df_msg)
+    val_msgs = df_msg[df_msg['kind'] == 'cal_validation'][-2:]
+    if len(val_msgs) < 2 or val_msgs['aborted'].iloc[0]:
         return default
 
-    left_index = int('LEFT' in val_msgs[1][1])
-    right_index = 1 - left_index
-    lefterror_index, righterror_index = val_msgs[left_index][1].split().index('ERROR'), val_msgs[right_index][
-        1].split().index('ERROR')
-    left_error = float(val_msgs[left_index][1].split()[lefterror_index + 1])
-    right_error = float(val_msgs[right_index][1].split()[righterror_index + 1])
+    left_msg, right_msg = val_msgs.iloc[1], val_msgs.iloc[0]
+    if left_msg['eye'] != 'L':
+        left_msg, right_msg = right_msg, left_msg
 
-    return 'L' if left_error < right_error else 'R'
+    return 'L' if left_msg['error'] < right_msg['error'] else 'R'
 
 
-def filter_msgs(df_msg, cutout=('validation', 'pseudocalib')):
-    first_index = df_msg.index[(df_msg['text'].str.contains(cutout[0]))
-                               | (df_msg['text'].str.contains(cutout[1]))].tolist()[0]
+def filter_msgs(df_msg, cutout='manual_validation'):
+    df_msg = parse_messages(df_msg)
+    first_index = df_msg.index[df_msg['kind'] == cutout][0]
 
-    return df_msg[first_index:]
+    return df_msg.loc[first_index:]
 
 
 def is_binocular(df_fix):
@@ -176,33 +331,28 @@ def keep_besteye(df_fix, df_msg, default='R'):
     return df_fix, best_eye
 
 
-def extract_calpoints(df_msg, best_eye, legend='Calibration points', npoints=9):
-    calpoints_msg = df_msg[df_msg['text'].str.contains(legend)]
-    calpoints = []
+def extract_calpoints(df_msg, best_eye, npoints=9):
+    df_msg = parse_messages(df_msg)
+    calpoints_msg = df_msg[df_msg['kind'] == 'cal_points']
+    calpoints = pd.DataFrame(columns=['x', 'y'])
     if not calpoints_msg.empty:
         if len(calpoints_msg) >= 2:
-            calpoints_msgidx = calpoints_msg.iloc[-2].name if best_eye == 'L' else calpoints_msg.iloc[-1].name
+            calpoints_msgidx = calpoints_msg.index[-2] if best_eye == 'L' else calpoints_msg.index[-1]
         else:
-            calpoints_msgidx = calpoints_msg.iloc[0].name
-        calpoints = df_msg.loc[calpoints_msgidx + 1:calpoints_msgidx + npoints]['text'].to_numpy()
-        calpoints = [list(map(lambda x: float(x.replace(',', '')), msg.split()[1:3])) for msg in calpoints]
-    calpoints = pd.DataFrame(calpoints, columns=['x', 'y'])
+            calpoints_msgidx = calpoints_msg.index[0]
+        calpoints = df_msg.loc[calpoints_msgidx + 1:calpoints_msgidx + npoints, ['x', 'y']]
+        calpoints = calpoints.reset_index(drop=True)
 
     return calpoints
 
 
-def extract_valpoints(df_msg, best_eye, legend='VALIDATE', npoints=9):
-    valpoints_msg = df_msg[df_msg['text'].str.contains(legend)]
+def extract_valpoints(df_msg, best_eye, npoints=9):
+    df_msg = parse_messages(df_msg)
+    valpoints_msg = df_msg[df_msg['kind'] == 'validate']
     if len(valpoints_msg) > npoints:
-        besteye_legend = 'RIGHT' if best_eye == 'R' else 'LEFT'
-        valpoints_msg = valpoints_msg[valpoints_msg['text'].str.contains(besteye_legend)]
-    valpoints_msg = valpoints_msg['text'].to_numpy()
-    points = [msg.split('at')[1].split('OFFSET')[0].split(',') for msg in valpoints_msg]
-    regexp = r'(-?\d+\.\d+)\s*,\s*(-?\d+\.\d+)\s*pix'
-    offsets = [re.findall(regexp, msg.split('at')[1].split('OFFSET')[1]) for msg in valpoints_msg]
-    offsets = [(float(offset[0][0]), float(offset[0][1])) for offset in offsets]
-    points = [(int(point[0]), int(point[1])) for point in points]
-    valpoints = pd.DataFrame(points, columns=['x', 'y']).astype(int)
-    valoffsets = pd.DataFrame(offsets, columns=['x', 'y']).astype(float)
+        valpoints_msg = valpoints_msg[valpoints_msg['eye'] == best_eye]
+    valpoints = valpoints_msg[['x', 'y']].reset_index(drop=True).astype(int)
+    valoffsets = valpoints_msg[['offset_x', 'offset_y']].reset_index(drop=True).astype(float)
+    valoffsets.columns = ['x', 'y']
 
     return valpoints, valoffsets
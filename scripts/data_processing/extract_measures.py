@@ -1,11 +1,12 @@
-from scripts.data_processing import utils
+from scripts.data_processing import utils, store, aggregates
 from pathlib import Path
+from scripts.data_processing import assign_fix_to_words
 from scripts.data_processing.assign_fix_to_words import assign_fixations_to_words
-from scripts.data_processing.utils import average_measures
 from tqdm import tqdm
 import argparse
 import pandas as pd
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 PUNCTUATION_MARKS = ['?', '!', '.']
 WEIRD_CHARS = ['¿', '?', '¡', '!', '.', '−', '1', '2', '3', '4', '5', '6', '7', '8', '9', '0']
@@ -14,6 +15,15 @@ CHARS_MAP = {'—': '', '‒': '', '−': '', '-': '', '«': '', '»': '',
              '“': '', '”': '', '\'': '', '\"': '', '‘': '', '’': '',
              '(': '', ')': '', ';': '', ',': '', ':': '', '.': '', '…': '',
              '¿': '', '?': '', '¡': '', '!': ''}
+MEASURES_DTYPES = {'subj': 'category', 'screen': 'int16', 'word_idx': 'int32', 'word': 'category',
+                   'sentence_idx': 'int32', 'sentence_pos': 'int16', 'screen_pos': 'int16', 'excluded': bool,
+                   'FFD': 'float32', 'SFD': 'float32', 'FPRT': 'float32', 'RPD': 'float32', 'TFD': 'float32',
+                   'RRT': 'float32', 'SPRT': 'float32', 'FC': 'int16', 'RC': 'int16'}
+WORDS_COLUMNS = ['subj', 'screen', 'word_idx', 'word', 'sentence_idx', 'sentence_pos', 'screen_pos', 'excluded']
+MEASURES = ['FFD', 'SFD', 'FPRT', 'RPD', 'TFD', 'RRT', 'SPRT', 'FC', 'RC']
+# Registries of the quantities computed for the words of a screen (name: (dependencies, function)), filled by the
+# intermediate and measure decorators. Intermediates (e.g. the first pass of each word) are shared by the measures
+INTERMEDIATES, MEASURES_FUNCTIONS = {}, {}
 
 """ Script to compute eye-tracking measures for each item based on words fixations.
     Measures extracted on a single trial basis:
@@ -42,22 +52,22 @@ CHARS_MAP = {'—': '', '‒': '', '−': '', '-': '', '«': '', '»': '',
 """
 
 
-def main(item, data_path, items_path, trials_path, save_path, reprocess):
+def main(item, data_path, items_path, trials_path, save_path, reprocess, jobs=None, chunksize=1, measures=MEASURES):
     subjects, items = utils.get_dirs(trials_path), utils.get_items(items_path, item)
-    assign_fixations_to_words(items, subjects, data_path, reprocess=False)
+    assign_fixations_to_words(items, subjects, data_path, reprocess=False, jobs=jobs, chunksize=chunksize)
     if item != 'all':
         items_wordsfix = [data_path / item]
     else:
         items_wordsfix = utils.get_dirs(data_path)
     chars_mapping = str.maketrans(CHARS_MAP)
-    extract_measures(items_wordsfix, chars_mapping, items_path, save_path, reprocess)
+    extract_measures(items_wordsfix, chars_mapping, items_path, save_path, reprocess, jobs, chunksize, measures)
 
 
 def words_measures(items_measures, save_path):
     excluded_words = items_measures[items_measures['excluded']]
     items_measures = items_measures[~items_measures['excluded']]
     items_measures = items_measures.drop(columns=['excluded'])
-    items_measures = items_measures.groupby(['word']).mean().round(2)
+    items_measures = items_measures.groupby(['word'], observed=True).mean().round(2)
     items_measures.to_csv(save_path / 'words_measures.csv')
     missing_words = set(excluded_words['word']) - set(items_measures.index)
     missing_words_df = pd.DataFrame(0, index=list(missing_words), columns=items_measures.columns)
@@ -65,193 +75,413 @@ def words_measures(items_measures, save_path):
     return items_measures
 
 
-def process_single_item(item, items_path, chars_mapping, reprocess, save_path):
-    screens_text = utils.load_lines_text_by_screen(item.stem, items_path)
-    item_measures_path = save_path / 'measures' / item.name
-    item_trials = get_trials_to_process(item, item_measures_path, reprocess)
-    if item_trials:
-        item_measures, item_scanpaths = extract_item_measures(screens_text, item_trials, chars_mapping)
-        item_measures = add_aggregated_measures(item_measures)
-        item_avg_measures = average_measures(item_measures,
-                                             measures=['FFD', 'SFD', 'FPRT', 'TFD', 'RPD', 'RRT', 'SPRT'],
-                                             n_bins=10)
-        utils.save_measures_by_subj(item_measures, item_measures_path)
-        return item.name, item_avg_measures, item_scanpaths
-    else:
-        return item.name, None, None
-
-
-def extract_measures(items_wordsfix, chars_mapping, items_path, save_path, reprocess=False):
+def extract_measures(items_wordsfix, chars_mapping, items_path, save_path, reprocess=False, jobs=None, chunksize=1,
+                     measures=MEASURES):
+    """ The given measures of each (item, subject) trial are computed as a separate task, the largest trials first.
+        Once all the trials of an item are done, a reduction task merges them into the item's aggregated state,
+        from which its averages are derived, and saves it with its scanpaths and the measures of the new subjects.
+        Averages and scanpaths of every item, including those with no new trials, are then saved again.
+        Items processed with other measures are processed again. """
     print(f'Extracting eye-tracking measures from trials...')
     items_measures = pd.DataFrame()
     items_scanpaths = {item.name: {} for item in items_wordsfix}
-
-    with ProcessPoolExecutor() as executor:
-        futures = {executor.submit(process_single_item, item, items_path, chars_mapping, reprocess, save_path):
-                       item for item in items_wordsfix}
-        for future in tqdm(as_completed(futures), total=len(items_wordsfix), desc='Processing items in parallel'):
-            item_name, item_avg_measures, item_scanpaths = future.result()
-            if item_avg_measures is not None:
-                items_measures = pd.concat([items_measures, item_avg_measures], ignore_index=True)
-                items_scanpaths[item_name] = item_scanpaths
+    items_reprocess = {item.name: reprocess or measures_changed(save_path, item.name, measures)
+                       for item in items_wordsfix}
+    items_trials = {item.name: get_trials_to_process(item, save_path, items_reprocess[item.name])
+                    for item in items_wordsfix}
+    for item in items_wordsfix:
+        if not items_trials[item.name]:
+            item_aggregates, _, items_scanpaths[item.name] = aggregates.load_aggregates(save_path, item.name)
+            if item_aggregates is not None:
+                items_measures = pd.concat([items_measures, aggregates.average_measures(item_aggregates)],
+                                           ignore_index=True)
+    # The words table of each item is sent along with its trials
+    items_words = {item.name: item_words(utils.load_lines_by_screen(items_path / f'{item.name}.mat'), chars_mapping)
+                   for item in items_wordsfix if items_trials[item.name]}
+    tasks = [(item.name, trial, items_words[item.name], measures)
+             for item in items_wordsfix for trial in items_trials[item.name]]
+    tasks_costs = [trial.stat().st_size for _, trial, _, _ in tasks]
+
+    items_results = {item_name: {} for item_name in items_trials}
+    with ProcessPoolExecutor(jobs) as executor, tqdm(total=len(tasks), desc='Processing trials in parallel') as pbar:
+        pending = utils.submit_longest_first(executor, process_trial, tasks, tasks_costs, chunksize)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if pending.pop(future) is None:
+                    item_name, item_avg_measures, item_scanpaths = future.result()
+                    items_measures = pd.concat([items_measures, item_avg_measures], ignore_index=True)
+                    items_scanpaths[item_name] = item_scanpaths
+                else:
+                    for item_name, trial, trial_results in future.result():
+                        items_results[item_name][trial] = trial_results
+                        pbar.update()
+                        if len(items_results[item_name]) == len(items_trials[item_name]):
+                            # Reduction tasks are marked with no chunk
+                            item_results = [items_results[item_name].pop(trial) for trial in items_trials[item_name]]
+                            item_subjects = [trial.stem for trial in items_trials[item_name]]
+                            pending[executor.submit(reduce_item_measures, item_name, item_subjects, item_results,
+                                                    items_path, chars_mapping, save_path, measures,
+                                                    items_reprocess[item_name])] = None
 
     if not items_measures.empty:
         words_avg_measures = words_measures(items_measures, save_path)
-        utils.save_subjects_scanpaths(items_scanpaths, words_avg_measures, chars_mapping, save_path, measure=None)
+        utils.save_subjects_scanpaths(items_scanpaths, words_avg_measures, chars_mapping, save_path,
+                                      measure=None, jobs=jobs)
 
 
-def extract_item_measures(screens_text, trials, chars_mapping):
-    measures, words_fix = [], []
-    for trial in trials:
-        trial_df = pd.read_pickle(trial)
-        add_trial_measures(trial_df, screens_text, chars_mapping, measures, words_fix)
-    measures = pd.DataFrame(measures, columns=['subj', 'screen', 'word_idx', 'word', 'sentence_idx', 'sentence_pos',
-                                               'screen_pos', 'excluded', 'FFD', 'SFD', 'FPRT', 'RPD', 'TFD', 'RRT',
-                                               'SPRT', 'FC', 'RC'])
+def process_trial(item_name, trial, words, measures):
+    return item_name, trial, trial_measures(store.load_partition(trial), words, measures)
 
-    words_fix = pd.DataFrame(words_fix, columns=['subj', 'fix_idx', 'fix_duration', 'word_idx'])
-    words_fix = words_fix.sort_values(['subj', 'fix_idx'])
-    scanpaths_texts = build_scanpaths(words_fix, screens_text, chars_mapping)
-    return measures, scanpaths_texts
 
+def reduce_item_measures(item_name, item_subjects, trials_results, items_path, chars_mapping, save_path, measures,
+                         reprocess):
+    screens_text = utils.load_lines_text_by_screen(item_name, items_path)
+    item_measures = pd.concat([measures for measures, _ in trials_results], ignore_index=True)
+    item_measures = item_measures.astype({column: dtype for column, dtype in MEASURES_DTYPES.items()
+                                          if column in item_measures})
+    words_fix = pd.concat([words_fix for _, words_fix in trials_results], ignore_index=True)
+    item_scanpaths = build_scanpaths(words_fix.sort_values(['subj', 'fix_idx']), screens_text, chars_mapping)
 
-def add_aggregated_measures(item_measures):
+    item_aggregates, processed_subjects, scanpaths = (None, [], {}) if reprocess else \
+        aggregates.load_aggregates(save_path, item_name)
     if not item_measures.empty:
-        valid_measures = item_measures[~item_measures['excluded']]
-        item_measures['LS'] = valid_measures.groupby(['word_idx'])['FPRT'].transform(lambda x: sum(x == 0) / len(x))
-        item_measures['RR'] = valid_measures.groupby(['word_idx'])['RRT'].transform(lambda x: sum(x > 0) / len(x))
-    return item_measures
-
-
-def add_trial_measures(trial, screens_text, chars_mapping, measures, words_fix):
-    word_idx, sentence_idx, sentence_pos = 0, 0, 0
-    for screen in screens_text:
+        item_aggregates = aggregates.merge_aggregates(item_aggregates, aggregates.item_aggregates(item_measures))
+    if item_aggregates is None:
+        return item_name, pd.DataFrame(), item_scanpaths
+    item_scanpaths = dict(sorted({**scanpaths, **item_scanpaths}.items()))
+
+    # Only the new subjects' measures are saved, as the across-trial ones are derived from the state when loading them
+    utils.save_measures_by_subj(item_measures, save_path / aggregates.MEASURES_DIR / item_name)
+    # The state is saved last, as it marks the subjects as processed
+    aggregates.save_aggregates(save_path, item_name, item_aggregates,
+                               sorted(set(processed_subjects) | set(item_subjects)), measures, item_scanpaths)
+    return item_name, aggregates.average_measures(item_aggregates), item_scanpaths
+
+
+def item_words(screens_lines, chars_mapping):
+    """ Table of the words of an item, which does not depend on the subject and is shared by all its trials.
+        Each word has its position (word_idx, screen, line, word_pos), its sentence (sentence_idx, sentence_pos),
+        its clean form and whether it is excluded. Lines are those of the words slots fixations are assigned to. """
+    screens_words = []
+    for screen, screen_lines in screens_lines.items():
         screen_words = []
-        add_words_to_list(screens_text[screen], screen_words)
-        screen_fix = trial[trial['screen'] == int(screen)]
-        if screen_fix.empty:
-            continue
-        for word_pos, word in enumerate(screen_words):
-            prev_word = screen_words[word_pos - 1] if word_pos > 0 else ''
-            clean_word = word.lower().translate(chars_mapping)
-            exclude = should_exclude_word(prev_word, word, clean_word, word_pos, line_num_words(word_pos, screen_fix))
-
-            word_fix = screen_fix[screen_fix['word_pos'] == word_pos]
-            add_word_fixations(word_fix, word_idx, words_fix)
-            add_word_measures(word_idx, clean_word, sentence_idx, sentence_pos, word_pos, exclude, word_fix,
-                              screen_fix, measures)
-            sentence_pos = sentence_pos + 1 if not is_end_of_sentence(word) else 0
-            sentence_idx = sentence_idx if not is_end_of_sentence(word) else sentence_idx + 1
-            word_idx += 1
+        add_words_to_list([line['text'] for line in screen_lines], screen_words)
+        lines_spaces, lines_nwords = assign_fix_to_words.lines_geometry(screen_lines)
+        slots = assign_fix_to_words.slots_words(np.array([len(spaces) - 1 for spaces in lines_spaces], dtype=int),
+                                                np.array(lines_nwords, dtype=int))
+        # Each word is in the first line with a slot for it
+        slots_pos, first_slots = np.unique(slots['word_pos'], return_index=True)
+        lines_last_word = np.full(len(screen_lines), -1)
+        np.maximum.at(lines_last_word, slots['line'], slots['word_pos'])
+        word_pos = np.arange(len(screen_words))
+        words_slot = np.minimum(np.searchsorted(slots_pos, word_pos), max(len(slots_pos) - 1, 0))
+        words_line = np.where(slots_pos[words_slot] == word_pos, slots['line'][first_slots][words_slot], -1) \
+            if len(slots_pos) else np.full(len(screen_words), -1)
+        line_nwords = np.where(words_line >= 0, lines_last_word[words_line], -1)
+
+        clean_words = [word.lower().translate(chars_mapping) for word in screen_words]
+        prev_words = [''] + screen_words[:-1]
+        screens_words.append(pd.DataFrame({
+            'screen': screen, 'line': words_line, 'word_pos': word_pos, 'word': clean_words,
+            'first_in_line': [is_first_word_in_line(pos) for pos in word_pos],
+            'last_in_line': [is_last_word_in_line(pos, line_nwords[pos]) for pos in word_pos],
+            'end_of_sentence': [is_end_of_sentence(word) for word in screen_words],
+            'excluded': [should_exclude_word(prev_word, word, clean_word, pos, line_nwords[pos])
+                         for prev_word, word, clean_word, pos in zip(prev_words, screen_words, clean_words, word_pos)]
+        }))
+    words = pd.concat(screens_words, ignore_index=True)
+    return number_words(words)
+
+
+def number_words(words):
+    """ Sets the index of each word in the text and the index of its sentence and its position in it """
+    end_of_sentence = words['end_of_sentence'].to_numpy()
+    word_idx = np.arange(len(words))
+    sentence_start = np.maximum.accumulate(np.where(np.append(True, end_of_sentence[:-1]), word_idx, 0))
+    return words.assign(word_idx=word_idx, sentence_idx=np.cumsum(end_of_sentence) - end_of_sentence,
+                        sentence_pos=word_idx - sentence_start)
+
+
+def trial_measures(trial, words, measures=MEASURES):
+    """ Given measures of every word of a trial, and the fixations on each word (for building its scanpath).
+        Words are numbered across screens, skipping the screens the subject did not read. """
+    screens_fix = {screen: screen_fix for screen, screen_fix in trial.groupby('screen')}
+    trial_words = words[words['screen'].isin(screens_fix)]
+    if len(trial_words) < len(words):
+        trial_words = number_words(trial_words)
+    subj_name = trial['subj'].iloc[0] if not trial.empty else ''
+
+    words_measures, words_fix = [], []
+    for screen, screen_words in trial_words.groupby('screen', sort=False):
+        screen_words_measures, screen_fixations = screen_measures(screens_fix[screen], len(screen_words), measures)
+        words_measures.append(screen_words_measures)
+        words_idx = screen_words['word_idx'].to_numpy()
+        words_fix.append(pd.DataFrame({'subj': subj_name, 'fix_idx': screen_fixations['trial_fix'],
+                                       'fix_duration': screen_fixations['duration'],
+                                       'word_idx': words_idx[screen_fixations['word_pos']]}))
+    if not words_measures:
+        return pd.DataFrame(columns=WORDS_COLUMNS + list(measures)), \
+            pd.DataFrame(columns=['subj', 'fix_idx', 'fix_duration', 'word_idx'])
+
+    trial_words_measures = pd.DataFrame({'subj': subj_name, 'screen': trial_words['screen'].to_numpy(),
+                                         'word_idx': trial_words['word_idx'].to_numpy(),
+                                         'word': trial_words['word'].to_numpy(),
+                                         'sentence_idx': trial_words['sentence_idx'].to_numpy(),
+                                         'sentence_pos': trial_words['sentence_pos'].to_numpy(),
+                                         'screen_pos': trial_words['word_pos'].to_numpy(),
+                                         'excluded': trial_words['excluded'].to_numpy()})
+    # Words with no fixations and excluded words have all their measures set to zero
+    words_measures = {name: np.concatenate([screen_words_measures[name] for screen_words_measures in words_measures])
+                      for name in ['fixated'] + list(measures)}
+    has_measures = words_measures['fixated'] & ~trial_words_measures['excluded'].to_numpy()
+    for measure in measures:
+        trial_words_measures[measure] = np.where(has_measures, words_measures[measure], 0)
+    return trial_words_measures, pd.concat(words_fix, ignore_index=True)
+
+
+def screen_measures(screen_fix, n_words, measures=MEASURES):
+    """ Given measures of the first n_words words of a screen, computed for all of them at once from the sequence of
+        fixations of the screen (grouped by word, keeping their order) and the intermediate quantities they depend
+        on, each computed once. Returns a dict of arrays indexed by word position (with whether each word was
+        fixated), and the fixations on those words. """
+    fixations = screen_fixations(screen_fix)
+    quantities = {'fixations': fixations}
+    words_measures = {'fixated': fixations['fixated'],
+                      **{measure: compute_quantity(measure, quantities) for measure in measures}}
+
+    # Words of the text with no rows are regarded as not fixated
+    words, word_pos = fixations['words'], fixations['word_pos']
+    positions = np.arange(n_words)
+    words_rows = np.minimum(np.searchsorted(words, positions), len(words) - 1)
+    in_screen = words[words_rows] == positions
+    words_measures = {name: values[words_rows] * in_screen for name, values in words_measures.items()}
+
+    words_fixations = fixations['fixated'][fixations['row_word']] & (word_pos < n_words)
+    screen_fix = fixations['screen_fix']
+    words_fixations = {'trial_fix': screen_fix['trial_fix'].array[words_fixations],
+                       'duration': screen_fix['duration'].array[words_fixations],
+                       'word_pos': word_pos[words_fixations]}
+    return words_measures, words_fixations
+
+
+def screen_fixations(screen_fix):
+    """ Fixations of a screen sorted by word, and the rows where the fixations of each word start and end """
+    screen_fix = screen_fix.iloc[np.argsort(screen_fix['word_pos'].to_numpy(), kind='stable')]
+    word_pos = screen_fix['word_pos'].to_numpy(dtype=int)
+    duration = np.nan_to_num(screen_fix['duration'].to_numpy(dtype=float, na_value=np.nan))
+    words, starts, words_nfix = np.unique(word_pos, return_index=True, return_counts=True)
+    fix_idx = screen_fix['screen_fix'].to_numpy(dtype=float, na_value=np.nan)
+    return {'screen_fix': screen_fix, 'word_pos': word_pos, 'fix_idx': fix_idx, 'duration': duration,
+            'labels': screen_fix.index.to_numpy(),
+            # Rows with no missing values, i.e. actual fixations
+            'is_fix': screen_fix.notna().all(axis=1).to_numpy(),
+            'words': words, 'starts': starts, 'ends': starts + words_nfix, 'words_nfix': words_nfix,
+            'row_word': np.repeat(np.arange(len(words)), words_nfix),
+            'cum_duration': np.concatenate([[0], np.cumsum(duration)]),
+            'fixated': np.logical_or.reduceat(screen_fix['trial_fix'].notna().to_numpy(), starts),
+            'first_fix': fix_idx[starts]}
+
+
+def compute_quantity(name, quantities):
+    """ Computes a registered quantity, and the ones it depends on, unless it is already in quantities """
+    if name not in quantities:
+        dependencies, function = INTERMEDIATES[name] if name in INTERMEDIATES else MEASURES_FUNCTIONS[name]
+        for dependency in dependencies:
+            compute_quantity(dependency, quantities)
+        quantities[name] = function(quantities)
+    return quantities[name]
+
+
+def register(registry, name, dependencies):
+    def decorator(function):
+        registry[name] = (dependencies, function)
+        return function
+    return decorator
+
+
+def intermediate(name, *dependencies):
+    return register(INTERMEDIATES, name, dependencies)
+
+
+def measure(name, *dependencies):
+    return register(MEASURES_FUNCTIONS, name, dependencies)
+
+
+@intermediate('first_right')
+def first_fixation_to_the_right(quantities):
+    """ First fixation on any word to the right of each word (inf if there is none) """
+    fixations = quantities['fixations']
+    words_first_fix = np.minimum.reduceat(np.where(fixations['is_fix'], fixations['fix_idx'], np.inf),
+                                          fixations['starts'])
+    return np.append(np.minimum.accumulate(words_first_fix[::-1])[::-1][1:], np.inf)
+
+
+@intermediate('first_pass', 'first_right')
+def first_pass(quantities):
+    """ Number of fixations of the leading run of consecutive fixations on each word,
+        unless a word to its right was fixated first """
+    fixations, first_right = quantities['fixations'], quantities['first_right']
+    fix_idx, starts = fixations['fix_idx'], fixations['starts']
+    consecutive = np.append(False, fix_idx[1:] == fix_idx[:-1] + 1)
+    consecutive[starts] = False
+    breaks = np.append(np.flatnonzero(~consecutive), len(fix_idx))
+    leading_run = np.minimum(breaks[np.searchsorted(breaks, starts, side='right')], fixations['ends']) - starts
+    return np.where(np.isfinite(first_right) & (first_right < fixations['first_fix']), 0, leading_run)
+
+
+@intermediate('first_exit', 'first_right')
+def first_exit(quantities):
+    """ Fixations on each word before the first fixation on a word to its right: the index label of the last one
+        and their duration """
+    fixations, first_right = quantities['fixations'], quantities['first_right']
+    fix_idx, starts, row_word = fixations['fix_idx'], fixations['starts'], fixations['row_word']
+    before_exit = np.isfinite(first_right)[row_word] & (fix_idx < first_right[row_word])
+    before_exit_fix = np.where(before_exit, fix_idx, -np.inf)
+    last_before_exit = np.maximum.reduceat(before_exit_fix, starts)
+    last_rows = np.flatnonzero(before_exit & (before_exit_fix == last_before_exit[row_word]))[::-1]
+    last_row = np.full(len(starts), -1)
+    last_row[row_word[last_rows]] = last_rows
+    has_exit = last_row != -1
+    cum_duration = fixations['cum_duration']
+    return {'has_exit': has_exit, 'last_label': np.where(has_exit, fixations['labels'][last_row], -1),
+            'duration': np.where(has_exit, cum_duration[last_row + 1] - cum_duration[starts], 0)}
+
+
+@intermediate('regression_path', 'first_exit')
+def regression_path(quantities):
+    """ Duration of the fixations on previous words after the first fixation on each word and before the index label
+        of its last fixation before exiting to the right (none if it never exits to the right) """
+    fixations, first_exit = quantities['fixations'], quantities['first_exit']
+    exit_words = np.flatnonzero(first_exit['has_exit'])
+    regressions = np.zeros(len(fixations['starts']))
+    # Fixations on previous words are the rows before the word's first row
+    keys = np.where(fixations['is_fix'], fixations['fix_idx'], 0)
+    regressions[exit_words] = prefix_range_sums(keys, np.where(fixations['is_fix'], fixations['duration'], 0),
+                                                fixations['starts'][exit_words], fixations['first_fix'][exit_words],
+                                                first_exit['last_label'][exit_words])
+    return regressions
+
+
+def prefix_range_sums(keys, values, ends, lower, upper):
+    """ Sum of values[:end] whose (non-negative) keys are in (lower, upper), for each end, lower and upper.
+        The rows before each end are split into aligned blocks of power-of-two sizes, one per set bit of end.
+        At each size, blocks are sorted by key along with the cumulative sum of their values, so that the sum over
+        a block takes two binary searches: O((len(keys) + len(ends)) * log(len(keys))) overall. """
+    sums = np.zeros(len(ends))
+    rows, span = np.arange(len(keys)), keys.max(initial=0) + 2
+    level = 0
+    while (1 << level) <= len(keys):
+        blocks = rows >> level
+        order = np.lexsort((keys, blocks))
+        blocks_keys = blocks[order] * span + keys[order]
+        cum_values = np.concatenate([[0], np.cumsum(values[order])])
+        in_prefix = ((ends >> level) & 1).astype(bool)
+        block_start = ((ends[in_prefix] >> level) - 1) * span
+        hi = np.searchsorted(blocks_keys, block_start + np.clip(upper[in_prefix], -1, span - 1), side='left')
+        lo = np.searchsorted(blocks_keys, block_start + np.clip(lower[in_prefix], -1, span - 1), side='right')
+        sums[in_prefix] += np.where(hi > lo, cum_values[hi] - cum_values[np.minimum(lo, hi)], 0)
+        level += 1
+    return sums
+
+
+@measure('FFD', 'first_pass')
+def first_fixation_duration(quantities):
+    fixations = quantities['fixations']
+    return np.where(quantities['first_pass'] > 0, fixations['duration'][fixations['starts']], 0)
 
 
-def build_scanpaths(words_fix, screens_text, chars_mapping):
-    item_text, item_sentences_ids = divide_into_words(screens_text)
-    item_text = pd.DataFrame({'word': item_text, 'sentence_id': item_sentences_ids})
-    scanpaths_text = {}
-    for subj in words_fix['subj'].unique():
-        subj_fix = words_fix[words_fix['subj'] == subj]
-        subj_scanpath_df = item_text.iloc[subj_fix['word_idx']]
-        subj_scanpath = subj_scanpath_df['word'].tolist()
-        sentences_ids = subj_scanpath_df['sentence_id'].tolist()
-        subj_scanpath = parse_sentences(subj_scanpath, sentences_ids, chars_mapping)
-        scanpaths_text[subj] = {'words': subj_scanpath, 'words_ids': subj_fix['word_idx'].tolist()}
-    return scanpaths_text
-
-
-def add_word_fixations(word_fix, word_idx, words_fix):
-    if not has_no_fixations(word_fix):
-        words_fix.extend([word_fix['subj'].iloc[0], fix_idx, fix_duration, word_idx]
-                         for fix_idx, fix_duration in zip(word_fix['trial_fix'], word_fix['duration']))
-
-
-def add_word_measures(word_idx, clean_word, sentence_idx, sentence_pos, screen_pos, exclude, word_fix, screen_fix,
-                      measures):
-    subj_name, screen, word_pos = word_fix['subj'].iloc[0], word_fix['screen'].iloc[0], word_fix['word_pos'].iloc[0]
-    if has_no_fixations(word_fix) or exclude:
-        measures.append([subj_name, screen, word_idx, clean_word, sentence_idx, sentence_pos, screen_pos, exclude,
-                         0, 0, 0, 0, 0, 0, 0, 0, 0])
-    else:
-        following_words_fix = screen_fix[screen_fix['word_pos'] > word_pos].dropna()
-        prev_words_fix = screen_fix[screen_fix['word_pos'] < word_pos].dropna()
-        ffd, sfd, fprt, rpd, tfd, rrt, sprt, fc, rc = word_measures(word_fix, prev_words_fix, following_words_fix)
-        measures.append([subj_name, screen, word_idx, clean_word, sentence_idx, sentence_pos, screen_pos, exclude,
-                         ffd, sfd, fprt, rpd, tfd, rrt, sprt, fc, rc])
-
-
-def word_measures(word_fix, prev_words_fix, following_words_fix):
-    n_first_pass_fix = first_pass_n_fix(word_fix, following_words_fix)
-    last_fix_before_exiting = last_fix_before_exiting_to_the_right(word_fix, following_words_fix)
-    regressions_to_prev = regressions_to_previous_words(word_fix, prev_words_fix, last_fix_before_exiting)
-    fix_dur_before_exiting_to_the_right = word_fix['duration'].loc[:last_fix_before_exiting].sum() \
-        if last_fix_before_exiting != -1 else 0
-    ffd = word_fix['duration'].iloc[0] if n_first_pass_fix > 0 else 0
-    sfd = ffd if len(word_fix['screen_fix']) == 1 else 0
-    fprt = word_fix['duration'][:n_first_pass_fix].sum()
-    rpd = regressions_to_prev + fix_dur_before_exiting_to_the_right
-    tfd = word_fix['duration'].sum()
-    rrt = rpd - fprt
-    sprt = tfd - fprt
-    fc = len(word_fix['screen_fix'])
-    rc = fc - n_first_pass_fix
-    return ffd, sfd, fprt, rpd, tfd, rrt, sprt, fc, rc
-
-
-def first_pass_n_fix(word_fix, following_words_fix):
-    # Count number of first pass reading fixations on word
-    fst_fix = word_fix['screen_fix'].iloc[0]
-    regressive_saccade = (following_words_fix['screen_fix'] < fst_fix).values.any()
-    if regressive_saccade:
-        # Word was first skipped and then fixated (i.e., right-to-left saccade)
-        return 0
-    else:
-        # This disregards intra-word regressions; inter-word regressions (rightward or leftward) are considered
-        return n_consecutive_fix(word_fix['screen_fix'])
-
+@measure('SFD', 'FFD')
+def single_fixation_duration(quantities):
+    return np.where(quantities['fixations']['words_nfix'] == 1, quantities['FFD'], 0)
 
-def last_fix_before_exiting_to_the_right(word_fix, following_words_fix):
-    first_fix_to_the_right = following_words_fix['screen_fix'].min()
-    fixs_before_exiting_to_the_right = word_fix[word_fix['screen_fix'] < first_fix_to_the_right]['screen_fix']
-    if not fixs_before_exiting_to_the_right.empty:
-        last_fix_idx = fixs_before_exiting_to_the_right.idxmax()
-    else:
-        last_fix_idx = -1
-    return last_fix_idx
 
+@measure('FPRT', 'first_pass')
+def first_pass_reading_time(quantities):
+    cum_duration, starts = quantities['fixations']['cum_duration'], quantities['fixations']['starts']
+    return cum_duration[starts + quantities['first_pass']] - cum_duration[starts]
+
+
+@measure('RPD', 'first_exit', 'regression_path')
+def regression_path_duration(quantities):
+    return quantities['regression_path'] + quantities['first_exit']['duration']
+
+
+@measure('TFD')
+def total_fixation_duration(quantities):
+    cum_duration, fixations = quantities['fixations']['cum_duration'], quantities['fixations']
+    return cum_duration[fixations['ends']] - cum_duration[fixations['starts']]
+
+
+@measure('RRT', 'RPD', 'FPRT')
+def re_reading_time(quantities):
+    return quantities['RPD'] - quantities['FPRT']
+
+
+@measure('SPRT', 'TFD', 'FPRT')
+def second_pass_reading_time(quantities):
+    return quantities['TFD'] - quantities['FPRT']
+
+
+@measure('FC')
+def fixation_count(quantities):
+    return quantities['fixations']['words_nfix']
 
-def regressions_to_previous_words(word_fix, prev_words_fix, last_fix_before_exiting):
-    return prev_words_fix[(prev_words_fix['screen_fix'] > word_fix['screen_fix'].iloc[0]) &
-                          (prev_words_fix['screen_fix'] < last_fix_before_exiting)]['duration'].sum()
 
+@measure('RC', 'first_pass')
+def regression_count(quantities):
+    return quantities['fixations']['words_nfix'] - quantities['first_pass']
 
-def n_consecutive_fix(fix_indices):
-    fix_counter = 1
-    for i, fix_idx in enumerate(fix_indices[:-1]):
-        if fix_idx != fix_indices.iloc[i + 1] - 1:
-            break
-        fix_counter += 1
 
-    return fix_counter
-
-
-def get_trials_to_process(item, item_savepath, reprocess):
-    trials_to_process = utils.get_files(item, 'pkl')
-    if item_savepath.exists() and not reprocess:
-        trials_to_process = [trial for trial in trials_to_process if not (item_savepath / trial.name).exists()]
+def build_scanpaths(words_fix, screens_text, chars_mapping):
+    """ Scanpath of each subject (words_fix is sorted by subject and fixation), built for all of them at once.
+        Punctuation is removed from a word followed by itself, and each word followed by a word from another
+        sentence is cleaned and marked as the end of a sentence. The last word of each scanpath is kept as is. """
+    if words_fix.empty:
+        return {}
+    item_text, item_sentences_ids = divide_into_words(screens_text)
+    stripped_words = [word.replace('.', '') for word in item_text]
+    clean_words = [word.translate(chars_mapping) for word in stripped_words]
+    words_forms = np.array([item_text, stripped_words, clean_words, [word + '.' for word in clean_words]], dtype=object)
+    # Words and their stripped forms are compared by their codes
+    words_codes = pd.factorize(np.array(item_text + stripped_words, dtype=object))[0]
+    text_codes, stripped_codes = words_codes[:len(item_text)], words_codes[len(item_text):]
+
+    subjects, words_idx = words_fix['subj'].to_numpy(), words_fix['word_idx'].to_numpy(dtype=int)
+    starts = np.append(0, np.flatnonzero(subjects[1:] != subjects[:-1]) + 1)
+    ends = np.append(starts[1:], len(words_fix))
+    is_first, is_last = np.zeros(len(words_fix), dtype=bool), np.zeros(len(words_fix), dtype=bool)
+    is_first[starts], is_last[ends - 1] = True, True
+
+    sentences_ids = np.array(item_sentences_ids)[words_idx]
+    # The sentence of the first word of each scanpath is regarded as the first one
+    ends_sentence = np.where(is_first, 0, sentences_ids) != np.roll(sentences_ids, -1)
+    is_repeated = stripped_codes[words_idx] == text_codes[np.roll(words_idx, -1)]
+    forms = np.where(is_last, 0, np.where(ends_sentence, 3, np.where(is_repeated, 2, 1)))
+    scanpaths_words = words_forms[forms, words_idx]
+
+    return {subjects[start]: {'words': scanpaths_words[start:end].tolist(), 'words_ids': words_idx[start:end].tolist()}
+            for start, end in zip(starts, ends)}
+
+
+def measures_changed(save_path, item_name, measures):
+    processed_measures = aggregates.processed_measures(save_path, item_name)
+    if processed_measures is None or set(processed_measures) == set(measures):
+        return False
+    print(f'{item_name}: processed with measures {processed_measures}, processing it again with {list(measures)}')
+    return True
+
+
+def get_trials_to_process(item, save_path, reprocess):
+    """ Subjects are processed once they are in the item's aggregated state (so items processed before it was
+        kept are processed again once, to build it) """
+    trials_to_process = store.item_partitions(item)
+    if not reprocess:
+        processed_subjects = aggregates.processed_subjects(save_path, item.name)
+        trials_to_process = [trial for trial in trials_to_process if trial.stem not in processed_subjects]
     return trials_to_process
 
 
-def parse_sentences(subj_scanpath, sentences_ids, chars_mapping):
-    curr_sentence_id = 0
-    for i, word in enumerate(subj_scanpath[:-1]):
-        next_word, next_sentence_id = subj_scanpath[i + 1], sentences_ids[i + 1]
-        word = word.replace('.', '')
-        word = word if word != next_word else word.translate(chars_mapping)
-        subj_scanpath[i] = word if curr_sentence_id == next_sentence_id else word.translate(chars_mapping) + '.'
-        curr_sentence_id = next_sentence_id
-    return subj_scanpath
-
-
 def divide_into_words(screens_text):
     item_text, sentences_ids = [], [0]
     for screenid in screens_text:
@@ -277,13 +507,6 @@ def num_words(text):
     return sum([len(line.split()) for line in text])
 
 
-def line_num_words(word_pos, screen_fix):
-    line_num = screen_fix[screen_fix['word_pos'] == word_pos]['line'].iloc[0]
-    line_nwords = screen_fix[screen_fix['line'] == line_num]['word_pos'].max()
-
-    return line_nwords
-
-
 def is_end_of_sentence(word):
     return bool([char for char in PUNCTUATION_MARKS if char in word])
 
@@ -309,10 +532,6 @@ def has_weird_chars(word):
     return any(char in word for char in WEIRD_CHARS)
 
 
-def has_no_fixations(word_fix):
-    return word_fix['trial_fix'].isna().all()
-
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Compute metrics based on words fixations')
     parser.add_argument('--data_path', type=str, default='../../data/processed/words_fixations',
@@ -324,9 +543,14 @@ if __name__ == '__main__':
     parser.add_argument('--save_path', type=str, default='../../results')
     parser.add_argument('--item', type=str, default='all')
     parser.add_argument('--reprocess', action='store_true')
+    parser.add_argument('--jobs', type=int, default=None, help='Number of processes (all cores by default)')
+    parser.add_argument('--chunksize', type=int, default=1, help='Number of trials sent to a process at a time')
+    parser.add_argument('--measures', type=str, nargs='+', default=MEASURES, choices=list(MEASURES_FUNCTIONS),
+                        help='Measures to compute (all of them by default)')
     args = parser.parse_args()
 
     data_path, trials_path, items_path, save_path = Path(args.data_path), Path(args.trials_path), \
         Path(args.items_path), Path(args.save_path)
 
-    main(args.item, data_path, items_path, trials_path, save_path, args.reprocess)
+    main(args.item, data_path, items_path, trials_path, save_path, args.reprocess, args.jobs, args.chunksize,
+         args.measures)
@@ -0,0 +1,103 @@
+from contextlib import closing
+from pathlib import Path
+from . import store
+import pandas as pd
+import argparse
+import sqlite3
+
+""" Index of the flags of every processed trial, kept in a SQLite database at the root of the processed trials.
+    The flags are still saved in each trial's bundle; the database mirrors them so that listing participants
+    and filtering correct trials take a single query instead of opening every trial.
+    It is updated by parse.py and utils.update_flags, and trials missing from it are indexed by sync_flags.
+    Each row keeps the modification time of the trial it was read from, so that rows of trials that were
+    written again afterwards (e.g. parsed again) are stale and read again from the trial. """
+
+DB_FILE = 'flags.db'
+FLAGS_TYPES = {'edited': bool, 'firstval_iswrong': bool, 'lastval_iswrong': bool, 'wrong_answers': int,
+               'iswrong': bool, 'session': int, 'shift_x': int}
+
+
+def connect(trials_path):
+    connection = sqlite3.connect(trials_path / DB_FILE, timeout=60)
+    connection.execute(f'CREATE TABLE IF NOT EXISTS flags (subj TEXT, item TEXT, {", ".join(FLAGS_TYPES)}, '
+                       f'mtime INTEGER, PRIMARY KEY (subj, item))')
+    columns = [column[1] for column in connection.execute('PRAGMA table_info(flags)')]
+    if 'mtime' not in columns:
+        # Databases created before the modification times were kept; all of their rows are stale
+        with connection:
+            connection.execute('ALTER TABLE flags ADD COLUMN mtime INTEGER')
+    return connection
+
+
+def save_flags(trial_path, trial_flags):
+    """ Has to be called once the trial has been written, as the row keeps its modification time """
+    trials_path, subj, item = trial_path.parent.parent, trial_path.parent.name, trial_path.name
+    flags = trial_flags.to_dict('records')[0]
+    values = [subj, item] + [flags[flag] for flag in FLAGS_TYPES] + [store.trial_mtime(trial_path)]
+    with closing(connect(trials_path)) as connection, connection:
+        connection.execute(f'INSERT OR REPLACE INTO flags VALUES ({", ".join("?" * len(values))})', values)
+
+
+def query_flags(trials_path, where='', params=()):
+    with closing(connect(trials_path)) as connection:
+        flags = pd.read_sql_query(f'SELECT * FROM flags {where} ORDER BY subj, item', connection, params=params)
+    return flags.astype({'subj': str, 'item': str, **FLAGS_TYPES})
+
+
+def load_flags(subj_path, items):
+    """ Flags of the given items of a participant, in the same format as the trial's flags frame.
+        Items that are not indexed or whose rows are stale are left out. """
+    subj_flags = query_flags(subj_path.parent, 'WHERE subj = ?', (subj_path.name,)).set_index('item')
+    return {item: trial_flags_frame(subj_flags.loc[item]) for item in items
+            if item in subj_flags.index and not is_stale(subj_path / item, subj_flags.loc[item, 'mtime'])}
+
+
+def trial_flags_frame(trial_flags):
+    return pd.DataFrame({flag: [trial_flags[flag]] for flag in FLAGS_TYPES}, index=[0]).astype(FLAGS_TYPES)
+
+
+def trials_status(trials_path, item):
+    """ Whether the trial of each subject is correct, i.e. it was edited and not flagged as wrong.
+        Subjects whose rows are stale are left out. """
+    flags = query_flags(trials_path, 'WHERE item = ?', (item,))
+    is_current = [not is_stale(trials_path / subj / item, mtime) for subj, mtime in zip(flags['subj'], flags['mtime'])]
+    flags = flags[is_current]
+    return dict(zip(flags['subj'], flags['edited'] & ~flags['iswrong']))
+
+
+def is_stale(trial_path, mtime):
+    """ Whether the trial was written after its row, or no longer exists """
+    return not store.trial_exists(trial_path) or pd.isna(mtime) or int(mtime) != store.trial_mtime(trial_path)
+
+
+def indexed_trials(trials_path):
+    """ Modification time of the trial of each indexed (subj, item) when its row was saved """
+    flags = query_flags(trials_path)
+    return dict(zip(zip(flags['subj'], flags['item']), flags['mtime']))
+
+
+def sync_flags(trials_path):
+    """ Indexes the trials that are not in the database (e.g. processed before it existed) or whose rows are
+        stale, and removes the ones that no longer exist. Directories without a stored trial are skipped. """
+    indexed = indexed_trials(trials_path)
+    processed = set()
+    for subj_path in [subj_path for subj_path in trials_path.iterdir() if subj_path.is_dir()]:
+        for trial_path in [trial_path for trial_path in subj_path.iterdir() if trial_path.is_dir()]:
+            if store.trial_exists(trial_path):
+                processed.add((subj_path.name, trial_path.name))
+            else:
+                print(f'Skipping {trial_path}: no trial stored')
+    for subj, item in sorted(processed):
+        trial_path = trials_path / subj / item
+        if (subj, item) not in indexed or is_stale(trial_path, indexed[(subj, item)]):
+            save_flags(trial_path, store.load_trial_frame(trial_path, 'flags'))
+    with closing(connect(trials_path)) as connection, connection:
+        connection.executemany('DELETE FROM flags WHERE subj = ? AND item = ?', sorted(set(indexed) - processed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index the flags of all processed trials')
+    parser.add_argument('--data_path', type=str, default='data/processed/trials')
+    args = parser.parse_args()
+
+    sync_flags(Path(args.data_path))
@@ -1,64 +1,126 @@
 from .et_utils import et_utils
 from pathlib import Path
 from scipy.io import loadmat
-from pandas import to_datetime, DataFrame
+from pandas import to_datetime, DataFrame, concat
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
 import argparse
 import shutil
-from . import utils
+from . import utils, store, flags_db
 
 """ EyeLink's EDF files are assumed to having been converted to ASCII with edf2asc.exe.
     This script extracts fixations from those files and proceeds to divide them by screen for each trial.
     Only one eye is used for fixation extraction, and the eye is chosen based on the calibration results. 
-    data structures consist of dataframes in pickle format."""
+    data structures consist of dataframes, stored in a single bundle per trial (see store.py)."""
 
+# Parsed .asc files are cached next to them, in the participant's ascii path
+ASC_CACHE = '.cache'
 
-def item(item, participant_path, ascii_path, config_file, stimuli_path, save_path):
+
+def item(item, participant_path, ascii_path, config, stimuli_path, save_path):
     print(f'Processing {item}')
     trial_metadata = loadmat(str(item), simplify_cells=True)
     item_session = trial_metadata['trial']['session']
 
     trial_metadata = trial_metadata['trial']
     trial_path = save_path / item.name.split('.')[0]
-    if trial_path.exists():
-        shutil.rmtree(trial_path)
-    trial_path.mkdir(parents=True)
 
     stimuli_index, subj_name = trial_metadata['stimuli_index'], trial_metadata['subjname']
     trial_fix, et_messages, cal_points, val_points, val_offsets =\
         get_eyetracking_data(participant_path / ascii_path, subj_name, stimuli_index)
-    utils.save_calibrationdata(cal_points, val_points, val_offsets, trial_path)
+    trial_frames = {}
+    utils.add_calibrationdata(cal_points, val_points, val_offsets, trial_frames)
 
-    manualval_results = save_manualvalidation_fixations(et_messages, trial_fix, trial_path)
+    manualval_results = save_manualvalidation_fixations(et_messages, trial_fix, trial_frames)
     screen_sequence = DataFrame.from_records(trial_metadata['sequence'])
-    stimuli = utils.load_stimuli(item.name[:-4], stimuli_path, config_file)
-    divide_data_by_screen(screen_sequence, et_messages, trial_fix, trial_path, stimuli, filter_outliers=True)
+    stimuli = utils.load_stimuli_text(item.name[:-4], stimuli_path)
+    stimuli['config'] = utils.item_config(item.name[:-4], config)
+    messages_index = screen_messages_index(et_messages)
+    trial_frames['messages_index'] = messages_index
+    divide_data_by_screen(screen_sequence, messages_index, trial_fix, trial_frames, stimuli, filter_outliers=True)
 
     flags = {'edited': False, 'firstval_iswrong': not manualval_results[0],
              'lastval_iswrong': not manualval_results[1], 'wrong_answers': 0, 'iswrong': False,
              'session': item_session, 'shift_x': 0}
-    utils.save_structs(et_messages,
-                       screen_sequence,
-                       DataFrame(trial_metadata['questions_answers']),
-                       DataFrame(trial_metadata['synonyms_answers']),
-                       DataFrame(flags, index=[0]),
-                       trial_path)
+    utils.add_structs(et_messages,
+                      screen_sequence,
+                      DataFrame(trial_metadata['questions_answers']),
+                      DataFrame(trial_metadata['synonyms_answers']),
+                      DataFrame(flags, index=[0]),
+                      trial_frames)
+    save_trial(trial_path, trial_frames)
+    flags_db.save_flags(trial_path, trial_frames['flags'])
 
 
-def participantdata(raw_path, participant, ascii_path, config_file, stimuli_path, save_path):
+def save_trial(trial_path, trial_frames):
+    """ The trial is written to a temporary directory which then replaces the previous one, if any,
+        so that a failed trial never leaves a partial (or empty) trial behind """
+    tmp_path = trial_path.with_name(trial_path.name + '.tmp')
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    tmp_path.mkdir(parents=True)
+    try:
+        utils.save_trial_frames(tmp_path, trial_frames)
+    except Exception:
+        shutil.rmtree(tmp_path)
+        raise
+    if trial_path.exists():
+        shutil.rmtree(trial_path)
+    tmp_path.rename(trial_path)
+
+
+def participantdata(raw_path, participant, ascii_path, config_file, stimuli_path, save_path, jobs=1):
     participant_path = raw_path / participant
     out_path = save_path / participant
     save_profile(participant_path, out_path)
-    items = participant_path.glob('*.mat')
-    for item in items:
-        if item.name == 'Test.mat' or item.name == 'metadata.mat':
-            continue
-        item(item, participant_path, ascii_path, config_file, stimuli_path, out_path)
+    trials = [(item_file, participant_path, out_path) for item_file in participant_items(participant_path)]
+    return process_trials(trials, ascii_path, config_file, stimuli_path, jobs)
 
 
-def rawdata(raw_path, ascii_path, config_file, stimuli_path, save_path):
+def rawdata(raw_path, ascii_path, config_file, stimuli_path, save_path, jobs=1):
     participants = utils.get_dirs(raw_path)
-    for participant in participants:
-        participantdata(raw_path, participant.name, ascii_path, config_file, stimuli_path, save_path)
+    trials = []
+    for participant_path in participants:
+        out_path = save_path / participant_path.name
+        save_profile(participant_path, out_path)
+        trials.extend((item_file, participant_path, out_path) for item_file in participant_items(participant_path))
+    return process_trials(trials, ascii_path, config_file, stimuli_path, jobs)
+
+
+def participant_items(participant_path):
+    return [item_file for item_file in participant_path.glob('*.mat')
+            if item_file.name != 'Test.mat' and item_file.name != 'metadata.mat']
+
+
+def process_trials(trials, ascii_path, config_file, stimuli_path, jobs=1):
+    """ Trials are (item file, participant path, save path) tuples. With more than one job, they are processed
+        in a pool of processes. Failed trials are reported at the end instead of stopping the run,
+        and their (trial path, error) pairs are returned. """
+    if jobs < 1:
+        raise ValueError('jobs must be at least 1: ' + str(jobs))
+    config = utils.load_matfile(config_file)
+    failed_trials = []
+    if jobs == 1:
+        for item_file, participant_path, out_path in trials:
+            try:
+                item(item_file, participant_path, ascii_path, config, stimuli_path, out_path)
+            except Exception as e:
+                failed_trials.append((out_path / item_file.stem, e))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(item, item_file, participant_path, ascii_path, config, stimuli_path, out_path):
+                       out_path / item_file.stem for item_file, participant_path, out_path in trials}
+            for future in tqdm(as_completed(futures), total=len(futures), desc='Processing trials in parallel'):
+                try:
+                    future.result()
+                except Exception as e:
+                    failed_trials.append((futures[future], e))
+    for trial_path, error in failed_trials:
+        print(f'Failed to process {trial_path}: {error!r}')
+    if failed_trials:
+        print(f'{len(failed_trials)} out of {len(trials)} trials could not be processed')
+    return failed_trials
 
 
 def save_profile(participant_rawpath, save_path):
@@ -76,11 +138,9 @@ def save_profile(participant_rawpath, save_path):
     DataFrame(profile).to_pickle(save_path / 'profile.pkl')
 
 
-def save_manualvalidation_fixations(et_messages, trial_fix, trial_path, val_legend=('validation', 'pseudocalib'),
-                                    num_points=9, points_area=56, error_margin=30):
-    val_msgs = et_messages[(et_messages['text'].str.contains(val_legend[0])) |
-                           (et_messages['text'].str.contains(val_legend[1]))]
-    fin_msgindex = et_messages[et_messages['text'].str.contains('termina experimento')].index[0]
+def save_manualvalidation_fixations(et_messages, trial_fix, trial_frames, num_points=9, points_area=56, error_margin=30):
+    val_msgs = et_messages[et_messages['kind'] == 'manual_validation']
+    fin_msgindex = et_messages.index[et_messages['kind'] == 'end_experiment'][0]
     first_val = val_msgs.loc[:fin_msgindex]
     last_val = val_msgs.loc[fin_msgindex:]
     # Add some time to let the eye get to the last point
@@ -89,15 +149,12 @@ def save_manualvalidation_fixations(et_messages, trial_fix, trial_path, val_lege
     last_valfix = trial_fix[
         (trial_fix['tStart'] >= last_val.iloc[0]['time']) & (trial_fix['tEnd'] <= last_val.iloc[-1]['time'] + 500)]
 
-    points_coords = utils.get_points_coords(val_msgs, num_points)
+    points_coords = val_msgs[['x', 'y']][:num_points].astype(int)
     firstval_iscorrect = check_validation_fixations(first_valfix, points_coords, num_points, points_area, error_margin)
     lastval_iscorrect = check_validation_fixations(last_valfix, points_coords, num_points, points_area, error_margin)
 
-    val_path = trial_path / 'manual_validation'
-    if not val_path.exists():
-        val_path.mkdir()
-    first_valfix.to_pickle(val_path / 'first.pkl')
-    last_valfix.to_pickle(val_path / 'last.pkl')
+    trial_frames['manual_validation/first'] = first_valfix
+    trial_frames['manual_validation/last'] = last_valfix
 
     return firstval_iscorrect, lastval_iscorrect
 
@@ -105,27 +162,67 @@ def save_manualvalidation_fixations(et_messages, trial_fix, trial_path, val_lege
 def check_validation_fixations(fixations, points_coords, num_points, points_area, error_margin):
     """ For each fixation, check if it is inside the area of the point.
         As we only advance the point index once we find a fixation inside the area,
-        the validation is correct only if the point index matches the number of points - 1. """
+        the validation is correct only if the point index matches the number of points - 1.
+        All fixations are checked against all points at once; then, for each point, the matched fixation is
+        the first one inside its area that comes after the fixation matched to the previous point. """
     fix_coords = fixations.loc[:, ['xAvg', 'yAvg']].astype(int).to_numpy()
-    point_index = 0
-    for (x, y) in fix_coords:
-        lower_bound = points_coords.iloc[point_index] - (points_area + error_margin)
-        upper_bound = points_coords.iloc[point_index] + (points_area + error_margin)
-        if (x in range(lower_bound.iloc[0], upper_bound.iloc[0])
-                and y in range(lower_bound.iloc[1], upper_bound.iloc[1])):
-            point_index += 1
-            if point_index == num_points - 1:
-                break
+    points = points_coords.to_numpy()[:num_points - 1]
+    lower_bounds, upper_bounds = points - (points_area + error_margin), points + (points_area + error_margin)
+    inside_area = np.all((fix_coords[:, np.newaxis] >= lower_bounds) & (fix_coords[:, np.newaxis] < upper_bounds),
+                         axis=2)
+    point_index, next_fix = 0, 0
+    for fixations_inside in inside_area.T:
+        matched_fix = np.flatnonzero(fixations_inside[next_fix:])
+        if not len(matched_fix):
+            break
+        next_fix += matched_fix[0] + 1
+        point_index += 1
 
     return point_index == num_points - 1
 
 
-def divide_data_by_screen(trial_sequence, et_messages, trial_fix, trial_path, stimuli, filter_outliers=True):
-    fix_filename, lines_filename = 'fixations.pkl', 'lines.pkl'
+def check_trials_validations(trials_path, num_points=9, points_area=56, error_margin=30):
+    """ Evaluates again the first and last manual validations of every processed trial and saves a summary table.
+        Useful for tuning points_area and error_margin across the whole dataset. """
+    validations = []
+    for subj_path in utils.get_dirs(trials_path):
+        for trial_path in utils.get_dirs(subj_path):
+            manualval_fixs, points_coords = utils.load_manualvaldata(trial_path, num_points)
+            firstval_iscorrect, lastval_iscorrect = [check_validation_fixations(fixations, points_coords, num_points,
+                                                                                points_area, error_margin)
+                                                     for fixations in manualval_fixs]
+            validations.append({'subj': subj_path.name, 'item': trial_path.name,
+                                'firstval_iscorrect': firstval_iscorrect, 'lastval_iscorrect': lastval_iscorrect})
+    validations = DataFrame(validations, columns=['subj', 'item', 'firstval_iscorrect', 'lastval_iscorrect'])
+    validations.to_csv(trials_path / 'manual_validations.csv', index=False)
+    print(f'{(~validations["firstval_iscorrect"]).sum()} wrong first validations, '
+          f'{(~validations["lastval_iscorrect"]).sum()} wrong last validations '
+          f'out of {len(validations)} trials')
+
+    return validations
+
+
+def screen_messages_index(et_messages, events=('ini', 'fin')):
+    """ Index of the messages sent when a screen is shown ('ini') and when it is left ('fin').
+        Each row holds the event, the screen ordinal in the trial sequence and its timestamp. """
+    events_index = []
+    for event in events:
+        event_times = et_messages.loc[et_messages['kind'] == f'screen_{event}', 'time'].to_numpy()
+        events_index.append(DataFrame({'event': event, 'ordinal': np.arange(len(event_times)), 'time': event_times}))
+    return concat(events_index, ignore_index=True)
+
+
+def divide_data_by_screen(trial_sequence, messages_index, trial_fix, trial_frames, stimuli, filter_outliers=True):
+    # Account for repeated screens (i.e. returning to it)
+    screens_visits = {}
+    screens_times = messages_index.pivot(index='ordinal', columns='event', values='time')
+    # Fixations are sorted in time, so each screen corresponds to a contiguous slice of them
+    fix_start, fix_end = trial_fix['tStart'].to_numpy(), trial_fix['tEnd'].to_numpy()
     for i, screen_id in enumerate(trial_sequence['currentscreenid']):
-        ini_time = et_messages[et_messages['text'].str.contains('ini')].iloc[i]['time']
-        fin_time = et_messages[et_messages['text'].str.contains('fin')].iloc[i]['time']
-        screen_fixations = trial_fix[(trial_fix['tStart'] > ini_time) & (trial_fix['tEnd'] < fin_time)]
+        ini_time, fin_time = screens_times.loc[i, 'ini'], screens_times.loc[i, 'fin']
+        first_fix = np.searchsorted(fix_start, ini_time, side='right')
+        last_fix = np.searchsorted(fix_end, fin_time, side='left')
+        screen_fixations = trial_fix.iloc[first_fix:last_fix]
         if filter_outliers:
             screen_fixations = screen_fixations[
                 (screen_fixations['duration'] > 50) & (screen_fixations['duration'] < 1000)]
@@ -133,23 +230,20 @@ def divide_data_by_screen(trial_sequence, et_messages, trial_fix, trial_path, st
             trial_sequence.drop(i, inplace=True)
             continue
 
-        screen_path = utils.get_screenpath(screen_id, trial_path)
         lines_coords = utils.default_screen_linescoords(screen_id, stimuli)
-        fixations_files = list(sorted(screen_path.glob(f'{fix_filename[:-4]}*')))
-        screenfix_filename, screenlines_filename = fix_filename, lines_filename
-        # Account for repeated screens (i.e. returning to it)
-        if len(fixations_files):
-            screenfix_filename = f'{fix_filename[:-4]}_{len(fixations_files)}.pkl'
-            screenlines_filename = f'{lines_filename[:-4]}_{len(fixations_files)}.pkl'
+        visit = screens_visits.get(screen_id, 0)
+        screens_visits[screen_id] = visit + 1
 
         screen_fixations.reset_index(inplace=True)
-        screen_fixations.to_pickle(screen_path / screenfix_filename)
-        utils.save_linescoords(lines_coords, screen_path, screenlines_filename)
+        trial_frames[store.visit_frame(screen_id, visit)] = screen_fixations
+        trial_frames[store.visit_frame(screen_id, visit, 'lines')] = utils.linescoords_frame(lines_coords)
 
 
 def get_eyetracking_data(asc_path, subj_name, stimuli_index):
     asc_file = asc_path / f'{subj_name}_{stimuli_index}.asc'
-    _, df_msg, df_fix, _, _, _ = et_utils.parse_asc(asc_file, verbose=False)
+    _, df_msg, df_fix, _, _, _ = et_utils.load_asc(asc_file, asc_path / ASC_CACHE, records={'MSG', 'EFIX'},
+                                                    verbose=False)
+    df_msg = et_utils.parse_messages(df_msg)
     df_fix, best_eye = et_utils.keep_besteye(df_fix, df_msg)
     cal_points = et_utils.extract_calpoints(df_msg, best_eye)
     val_points, val_offsets = et_utils.extract_valpoints(df_msg, best_eye)
@@ -159,7 +253,7 @@ def get_eyetracking_data(asc_path, subj_name, stimuli_index):
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Extract data from EyeLink .asc files and save them to .pkl')
+    parser = argparse.ArgumentParser(description='Extract data from EyeLink .asc files and save them by trial')
     parser.add_argument('--path', type=str, default='data/raw', help='Path where participants data is stored')
     parser.add_argument('--ascii_path', type=str, default='asc',
                         help='Path where .asc files are stored in a participants folder')
@@ -169,10 +263,19 @@ if __name__ == '__main__':
     parser.add_argument('--save_path', type=str, default='data/processed/trials',
                         help='Path where to save the processed data')
     parser.add_argument('--subj', type=str, help='Subject name', required=False)
+    parser.add_argument('--jobs', type=int, default=1, help='Number of trials to process in parallel')
+    parser.add_argument('--check_validation', action='store_true',
+                        help='Only evaluate again the manual validations of the already processed trials')
+    parser.add_argument('--points_area', type=int, default=56, help='Radius of the manual validation points')
+    parser.add_argument('--error_margin', type=int, default=30, help='Error margin around validation points')
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
 
     raw_path, stimuli_path, save_path = Path(args.path), Path(args.stimuli_path), Path(args.save_path)
-    if not args.subj:
-        rawdata(raw_path, args.ascii_path, args.config, stimuli_path, save_path)
+    if args.check_validation:
+        check_trials_validations(save_path, points_area=args.points_area, error_margin=args.error_margin)
+    elif not args.subj:
+        rawdata(raw_path, args.ascii_path, args.config, stimuli_path, save_path, args.jobs)
     else:
-        participantdata(raw_path, args.subj, args.ascii_path, args.config, stimuli_path, save_path)
+        participantdata(raw_path, args.subj, args.ascii_path, args.config, stimuli_path, save_path, args.jobs)
@@ -31,9 +31,9 @@ def trial(stimuli, trial_path, editable=False):
     return save_files
 
 
-def calibration(trial_path, calibration_path='calibration', manualval_path='manual_validation'):
-    cal_points, val_points, val_offsets = utils.load_calibrationdata(trial_path / calibration_path)
-    manualval_fixs, manualval_points = utils.load_manualvaldata(trial_path / manualval_path, trial_path)
+def calibration(trial_path):
+    cal_points, val_points, val_offsets = utils.load_calibrationdata(trial_path)
+    manualval_fixs, manualval_points = utils.load_manualvaldata(trial_path)
 
     screens = [drawing.screen(), drawing.screen(val_points),
                drawing.screen(manualval_points), drawing.screen(manualval_points)]
@@ -0,0 +1,275 @@
+from pathlib import Path
+import pandas as pd
+import numpy as np
+import argparse
+import json
+import os
+
+""" Single-file storage for processed trials.
+    Every dataframe of a trial (fixations and lines of each screen visit, messages, calibration, flags, etc.)
+    is stored as a named frame in one uncompressed npz bundle. Frame names mirror the former pickle tree,
+    e.g. 'screen_3/fixations_1', 'calibration/val_points' or 'flags'.
+    Each column is a separate array, so reading a single frame does not deserialize the rest of the trial.
+    Per-subject outputs (words fixations, measures) are stored as datasets partitioned by item and subject:
+    <dataset>/<item>/<subj>.npz, which can be loaded with a subset of items, subjects and columns. """
+
+TRIAL_FILE = 'trial.npz'
+SCHEMA = '__schema__'
+INDEX = '__index__'
+PARTITION = 'data'
+
+
+def save_frames(file, frames):
+    arrays = {}
+    for name, frame in frames.items():
+        arrays.update(encode_frame(name, frame))
+    # Write to a temporary file first so that an interrupted save never leaves a corrupt bundle
+    tmp_file = file.with_name(file.name + '.tmp')
+    with tmp_file.open('wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_file, file)
+
+
+def load_frames(file, names=None, columns=None):
+    with np.load(file, allow_pickle=True) as bundle:
+        if names is None:
+            names = bundle_frames(bundle)
+        return {name: decode_frame(name, bundle, columns) for name in names}
+
+
+def frames_names(file):
+    with np.load(file, allow_pickle=True) as bundle:
+        return bundle_frames(bundle)
+
+
+def bundle_frames(bundle):
+    return [key[:-len(SCHEMA) - 1] for key in bundle.files if key.endswith(f'/{SCHEMA}')]
+
+
+def encode_frame(name, frame):
+    arrays = {}
+    schema = {'columns': [], 'index': encode_index(name, frame.index, arrays)}
+    for i, column in enumerate(frame.columns):
+        schema['columns'].append({'name': column, **encode_column(f'{name}/{i}', frame[column], arrays)})
+    # Frames built from lists have unnamed columns (0, 1, ...)
+    schema['range_columns'] = isinstance(frame.columns, pd.RangeIndex)
+    arrays[f'{name}/{SCHEMA}'] = np.array(json.dumps(schema))
+    return arrays
+
+
+def decode_frame(name, bundle, columns=None):
+    """ If columns is given, only those columns are read (in that order) """
+    schema = json.loads(bundle[f'{name}/{SCHEMA}'].item())
+    frame_columns = {column['name']: i for i, column in enumerate(schema['columns'])}
+    if columns is None:
+        columns = list(frame_columns)
+    missing_columns = [column for column in columns if column not in frame_columns]
+    if missing_columns:
+        raise KeyError(f'{missing_columns} not in frame {name}')
+    data = {i: decode_column(f'{name}/{frame_columns[column]}', schema['columns'][frame_columns[column]], bundle)
+            for i, column in enumerate(columns)}
+    frame = pd.DataFrame(data, index=decode_index(name, schema['index'], bundle))
+    if schema['range_columns'] and len(columns) == len(frame_columns):
+        frame.columns = pd.RangeIndex(len(columns))
+    else:
+        frame.columns = columns
+    return frame
+
+
+def encode_index(name, index, arrays):
+    if isinstance(index, pd.RangeIndex):
+        return {'name': index.name, 'range': [index.start, index.stop, index.step]}
+    return {'name': index.name, **encode_column(f'{name}/{INDEX}', index.to_series(), arrays)}
+
+
+def decode_index(name, index, bundle):
+    if 'range' in index:
+        return pd.RangeIndex(*index['range'], name=index['name'])
+    return pd.Index(decode_column(f'{name}/{INDEX}', index, bundle), name=index['name'])
+
+
+def encode_column(key, series, arrays):
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        arrays[key] = series.cat.codes.to_numpy()
+        return {'dtype': 'category', 'ordered': bool(dtype.ordered),
+                'categories': encode_column(f'{key}.categories', series.cat.categories.to_series(), arrays)}
+    if hasattr(dtype, 'na_value') and hasattr(dtype, 'numpy_dtype'):
+        # Nullable dtypes (e.g. Int64) are stored as the data filled with zeros plus the missing values mask
+        mask = series.isna().to_numpy()
+        arrays[key] = series.to_numpy(dtype=dtype.numpy_dtype, na_value=0)
+        arrays[f'{key}.mask'] = mask
+        return {'dtype': str(dtype), 'nullable': True}
+    values = series.to_numpy()
+    if dtype == object and len(values) and all(isinstance(value, str) for value in values):
+        values = values.astype(str)
+    arrays[key] = values
+    return {'dtype': str(dtype)}
+
+
+def decode_column(key, column, bundle):
+    if column['dtype'] == 'category':
+        categories = decode_column(f'{key}.categories', column['categories'], bundle)
+        return pd.Categorical.from_codes(bundle[key], categories, ordered=column['ordered'])
+    values = bundle[key]
+    if column.get('nullable'):
+        return pd.Series(values, dtype=column['dtype']).mask(bundle[f'{key}.mask']).array
+    if column['dtype'] == 'object':
+        values = values.astype(object)
+    return values
+
+
+def trial_file(trial_path):
+    return trial_path / TRIAL_FILE
+
+
+def is_legacy_trial(trial_path):
+    return not trial_file(trial_path).exists() and any(trial_path.glob('*.pkl'))
+
+
+def trial_exists(trial_path):
+    """ Whether the trial has been stored, either as a bundle or as a pickle tree """
+    return trial_file(trial_path).exists() or is_legacy_trial(trial_path)
+
+
+def trial_mtime(trial_path):
+    """ Last modification time of the stored trial, in microseconds (exact even when read as a float) """
+    if is_legacy_trial(trial_path):
+        return max(pkl_file.stat().st_mtime_ns for pkl_file in trial_path.rglob('*.pkl')) // 1000
+    return trial_file(trial_path).stat().st_mtime_ns // 1000
+
+
+def legacy_frames_names(trial_path):
+    return sorted(pkl_file.relative_to(trial_path).with_suffix('').as_posix()
+                  for pkl_file in trial_path.rglob('*.pkl'))
+
+
+def trial_size(trial_path):
+    """ Size in bytes of the stored trial, a proxy for its number of fixations """
+    if is_legacy_trial(trial_path):
+        return sum(pkl_file.stat().st_size for pkl_file in trial_path.rglob('*.pkl'))
+    return trial_file(trial_path).stat().st_size if trial_file(trial_path).exists() else 0
+
+
+def trial_frames_names(trial_path):
+    if is_legacy_trial(trial_path):
+        return legacy_frames_names(trial_path)
+    return frames_names(trial_file(trial_path))
+
+
+def load_trial_frame(trial_path, name):
+    if is_legacy_trial(trial_path):
+        return pd.read_pickle(trial_path / f'{name}.pkl')
+    return load_frames(trial_file(trial_path), [name])[name]
+
+
+def load_trial_frames(trial_path, names=None):
+    if is_legacy_trial(trial_path):
+        names = legacy_frames_names(trial_path) if names is None else names
+        return {name: pd.read_pickle(trial_path / f'{name}.pkl') for name in names}
+    return load_frames(trial_file(trial_path), names)
+
+
+def save_trial_frames(trial_path, frames, drop=None):
+    """ Adds (or replaces) frames in the trial bundle. Frames selected by drop(name) are removed.
+        Trials still stored as pickle trees are migrated on the first write. """
+    if trial_file(trial_path).exists() or is_legacy_trial(trial_path):
+        trial_frames = load_trial_frames(trial_path)
+    else:
+        trial_frames = {}
+    if drop is not None:
+        trial_frames = {name: frame for name, frame in trial_frames.items() if not drop(name)}
+    trial_frames.update(frames)
+    legacy_files = list(trial_path.rglob('*.pkl'))
+    save_frames(trial_file(trial_path), trial_frames)
+    remove_legacy_files(trial_path, legacy_files)
+
+
+def remove_legacy_files(trial_path, legacy_files):
+    for legacy_file in legacy_files:
+        legacy_file.unlink()
+    for legacy_dir in sorted({legacy_file.parent for legacy_file in legacy_files} - {trial_path}, reverse=True):
+        if not any(legacy_dir.iterdir()):
+            legacy_dir.rmdir()
+
+
+def screen_visits(trial_path, screenid, kind='fixations'):
+    """ Names of the frames of a screen, one per visit, ordered by visit ('fixations', 'fixations_1', ...) """
+    prefix = f'screen_{screenid}/{kind}'
+    names = [name for name in trial_frames_names(trial_path) if name == prefix or name.startswith(f'{prefix}_')]
+    return sorted(names, key=visit_number)
+
+
+def visit_frame(screenid, visit, kind='fixations'):
+    return f'screen_{screenid}/{kind}' + (f'_{visit}' if visit > 0 else '')
+
+
+def visit_number(name):
+    suffix = name.split('/')[-1].rpartition('_')[2]
+    return int(suffix) if suffix.isdigit() else 0
+
+
+def save_partition(item_path, subj, frame):
+    item_path.mkdir(parents=True, exist_ok=True)
+    save_frames(item_path / f'{subj}.npz', {PARTITION: frame})
+
+
+def load_partition(file, columns=None):
+    if file.suffix == '.pkl':
+        # Partitions written before datasets were stored as npz
+        frame = pd.read_pickle(file)
+        return frame if columns is None else frame[columns]
+    return load_frames(file, [PARTITION], columns)[PARTITION]
+
+
+def item_partitions(item_path, subjects=None):
+    """ Partition file of each subject of an item, sorted by subject """
+    partitions = {file.stem: file for file in item_path.glob('*.pkl')}
+    partitions.update({file.stem: file for file in item_path.glob('*.npz')})
+    return [partitions[subj] for subj in sorted(partitions) if subjects is None or subj in subjects]
+
+
+def load_dataset(dataset_path, columns=None, items=None, subjects=None):
+    """ Loads the partitions of the given items and subjects (all of them by default) into a single dataframe.
+        Only the selected partitions are opened and only the requested columns are read from them.
+        The item of each row is added as the first (categorical) column. """
+    items_paths = sorted(path for path in dataset_path.iterdir() if path.is_dir()
+                         and (items is None or path.name in items))
+    frames = []
+    for item_path in items_paths:
+        for partition in item_partitions(item_path, subjects):
+            frame = load_partition(partition, columns)
+            frame.insert(0, 'item', pd.Categorical.from_codes(np.zeros(len(frame), dtype=np.int8), [item_path.name]))
+            frames.append(frame)
+    if not frames:
+        return pd.DataFrame(columns=['item'] + (columns or []))
+    return concat_frames(frames)
+
+
+def concat_frames(frames):
+    """ Columns that are categorical in every frame remain categorical, with the union of their categories """
+    for column in frames[0].columns:
+        if all(isinstance(frame[column].dtype, pd.CategoricalDtype) for frame in frames):
+            categories = pd.Index(np.unique(np.concatenate([frame[column].cat.categories for frame in frames])))
+            for frame in frames:
+                frame[column] = frame[column].cat.set_categories(categories)
+    return pd.concat(frames, ignore_index=True)
+
+
+def migrate_trials(data_path):
+    """ Converts every trial of every participant stored as a pickle tree into a single bundle """
+    migrated = 0
+    for subj_path in sorted(path for path in data_path.iterdir() if path.is_dir()):
+        for trial_path in sorted(path for path in subj_path.iterdir() if path.is_dir()):
+            if is_legacy_trial(trial_path):
+                save_trial_frames(trial_path, {})
+                migrated += 1
+    print(f'{migrated} trials migrated')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate processed trials from pickle trees to single-file bundles')
+    parser.add_argument('--data_path', type=str, default='data/processed/trials')
+    args = parser.parse_args()
+
+    migrate_trials(Path(args.data_path))
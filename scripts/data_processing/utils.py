@@ -1,9 +1,17 @@
 from scipy.io import loadmat
 from tkinter import messagebox
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
 import numpy as np
+import pickle
 import json
-import shutil
+import os
+from . import store, flags_db
+from .et_utils import et_utils
+
+# Text and geometry of the stimuli (i.e. everything but the images) are cached next to them
+STIMULI_CACHE = '.cache'
 
 
 def log(x):
@@ -15,13 +23,6 @@ def reorder(trials, stimuli_order):
     return ordered_trials
 
 
-def get_screenpath(screenid, item_path):
-    screen_path = item_path / ('screen_' + str(screenid))
-    if not screen_path.exists():
-        screen_path.mkdir()
-    return screen_path
-
-
 def get_dirs(datapath, by_date=False):
     dirs = [dir_ for dir_ in datapath.iterdir() if dir_.is_dir()]
     if by_date:
@@ -34,6 +35,18 @@ def get_files(datapath, extension='*'):
     return files
 
 
+def submit_longest_first(executor, task, tasks_args, tasks_costs, chunksize=1):
+    """ Submits the tasks in chunks of consecutive tasks, from the most to the least costly, so that long tasks
+        do not end up running alone at the end. Returns a dict mapping each future to the args of its chunk """
+    order = sorted(range(len(tasks_args)), key=lambda i: -tasks_costs[i])
+    chunks = [[tasks_args[i] for i in order[start:start + chunksize]] for start in range(0, len(order), chunksize)]
+    return {executor.submit(run_chunk, task, chunk): chunk for chunk in chunks}
+
+
+def run_chunk(task, chunk):
+    return [task(*task_args) for task_args in chunk]
+
+
 def get_items(items_path, item_name):
     return [items_path / f'{item_name}.mat'] if item_name != 'all' else \
             [item for item in get_files(items_path, 'mat') if item.stem != 'Test']
@@ -45,21 +58,32 @@ def get_subjects(item_path):
 
 
 def get_correct_trials(subjects, item_name):
+    subjects = [subject for subject in subjects if store.trial_exists(subject / item_name)]
+    trials_status = flags_db.trials_status(subjects[0].parent, item_name) if subjects else {}
     correct_trials = [subject for subject in subjects
-                      if (subject / item_name).exists() and trial_is_correct(subject, item_name)]
+                      if trials_status.get(subject.name) or
+                      (subject.name not in trials_status and trial_is_correct(subject, item_name))]
     return correct_trials
 
 
-def save_screensequence(screens_sequence, item_path, filename='screen_sequence.pkl'):
-    screens_sequence.to_pickle(item_path / filename)
+def save_trial_frames(trial_path, trial_frames):
+    store.save_trial_frames(trial_path, trial_frames)
 
 
-def load_profile(profile_path, filename='profile.pkl'):
-    return pd.read_pickle(profile_path / filename)
+def load_trial_frame(trial_path, name):
+    return store.load_trial_frame(trial_path, name)
+
+
+def save_screensequence(screens_sequence, item_path):
+    save_trial_frames(item_path, {'screen_sequence': screens_sequence})
+
 
+def load_messages_index(item_path):
+    return load_trial_frame(item_path, 'messages_index')
 
-def load_pickle(path, filename):
-    return pd.read_pickle(path / filename)
+
+def load_profile(profile_path, filename='profile.pkl'):
+    return pd.read_pickle(profile_path / filename)
 
 
 def load_json(path, filename):
@@ -67,13 +91,24 @@ def load_json(path, filename):
         return json.load(file)
 
 
-def update_flags(trial_flags, trial_path, filename='flags.pkl'):
-    trial_flags.to_pickle(trial_path / filename)
+def update_flags(trial_flags, trial_path):
+    save_trial_frames(trial_path, {'flags': trial_flags})
+    flags_db.save_flags(trial_path, trial_flags)
 
 
-def load_flags(trials, datapath, filename='flags.pkl'):
-    flags = {trial: pd.read_pickle(datapath / trial / filename) for trial in trials}
-    return flags
+def load_flags(trials, datapath):
+    flags = flags_db.load_flags(datapath, trials)
+    for trial in trials:
+        if trial not in flags:
+            # Trial not indexed yet
+            flags[trial] = load_trial_frame(datapath / trial, 'flags')
+            flags_db.save_flags(datapath / trial, flags[trial])
+    return {trial: flags[trial] for trial in trials}
+
+
+def load_participants_flags(trials_path):
+    flags_db.sync_flags(trials_path)
+    return flags_db.query_flags(trials_path)
 
 
 def trial_is_correct(subject, item_name):
@@ -82,7 +117,7 @@ def trial_is_correct(subject, item_name):
 
 
 def load_questions_and_words(questions_file, item):
-    all_questionswords = load_matfile(questions_file)['stimuli_questions']
+    all_questionswords = load_questions(questions_file)
     questions, possible_answers, words = [], [], []
     for item_dict in all_questionswords:
         if item_dict['title'] == item:
@@ -93,12 +128,21 @@ def load_questions_and_words(questions_file, item):
     return questions, possible_answers, words
 
 
+def load_questions(questions_file):
+    return cached_questions(str(questions_file), os.stat(questions_file).st_mtime_ns)
+
+
+@lru_cache(maxsize=4)
+def cached_questions(questions_file, mtime_ns):
+    return load_matfile(questions_file)['stimuli_questions']
+
+
 def load_matfile(matfile):
     return loadmat(str(matfile), simplify_cells=True)
 
 
-def load_answers(trial_path, filename):
-    answers = pd.read_pickle(trial_path / filename)
+def load_answers(trial_path, name):
+    answers = load_trial_frame(trial_path, name)
     return list(answers[0].to_numpy())
 
 
@@ -128,50 +172,38 @@ def update_and_save_trial(sequence_states, stimuli, trial_path):
 
 
 def save_trial(screens_fixations, screens_lines, del_seqindices, item_path):
-    fix_filename = 'fixations.pkl'
-    lines_filename = 'lines.pkl'
+    trial_frames = {}
     for screen_id in screens_fixations:
-        screen_fixations, screen_lines = screens_fixations[screen_id], screens_lines[screen_id]
-        screen_path = get_screenpath(screen_id, item_path)
-        if screen_path.exists():
-            shutil.rmtree(screen_path)
-        screen_path.mkdir()
-
-        screenfix_filename = fix_filename
-        screenlines_filename = lines_filename
-        for fixations, lines in zip(screen_fixations, screen_lines):
-            fixations_files = list(sorted(screen_path.glob(f'{fix_filename[:-4]}*')))
-            # Account for repeated screens (i.e. returning to it)
-            if len(fixations_files):
-                screenfix_filename = f'{fix_filename[:-4]}_{len(fixations_files)}.pkl'
-                screenlines_filename = f'{lines_filename[:-4]}_{len(fixations_files)}.pkl'
+        # Account for repeated screens (i.e. returning to it); empty visits are not saved
+        visit = 0
+        for fixations, lines in zip(screens_fixations[screen_id], screens_lines[screen_id]):
             if len(fixations):
-                fixations.to_pickle(screen_path / screenfix_filename)
-                save_linescoords(lines, screen_path, screenlines_filename)
+                trial_frames[store.visit_frame(screen_id, visit)] = fixations
+                trial_frames[store.visit_frame(screen_id, visit, 'lines')] = linescoords_frame(lines)
+                visit += 1
 
     screen_sequence = load_screensequence(item_path)
     screen_sequence.drop(index=screen_sequence.iloc[del_seqindices].index, inplace=True)
-    save_screensequence(screen_sequence, item_path)
+    trial_frames['screen_sequence'] = screen_sequence
+    edited_screens = tuple(f'screen_{screen_id}/' for screen_id in screens_fixations)
+    store.save_trial_frames(item_path, trial_frames, drop=lambda name: name.startswith(edited_screens))
 
 
-def save_linescoords(lines, screen_path, filename='lines.pkl'):
-    pd.DataFrame(lines, columns=['y']).to_pickle(screen_path / filename)
+def linescoords_frame(lines):
+    return pd.DataFrame(lines, columns=['y'])
 
 
-def save_calibrationdata(cal_points, val_points, val_offsets, trial_path):
-    save_path = trial_path / 'calibration'
-    if not save_path.exists():
-        save_path.mkdir()
-    cal_points.to_pickle(save_path / 'cal_points.pkl')
-    val_points.to_pickle(save_path / 'val_points.pkl'), val_offsets.to_pickle(save_path / 'val_offsets.pkl')
+def add_calibrationdata(cal_points, val_points, val_offsets, trial_frames):
+    trial_frames['calibration/cal_points'] = cal_points
+    trial_frames['calibration/val_points'], trial_frames['calibration/val_offsets'] = val_points, val_offsets
 
 
-def save_structs(et_messages, screen_sequence, answers, words, flags, trial_path):
-    et_messages.to_pickle(trial_path / 'et_messages.pkl')
-    screen_sequence.to_pickle(trial_path / 'screen_sequence.pkl')
-    answers.to_pickle(trial_path / 'answers.pkl')
-    words.to_pickle(trial_path / 'words.pkl')
-    flags.to_pickle(trial_path / 'flags.pkl')
+def add_structs(et_messages, screen_sequence, answers, words, flags, trial_frames):
+    trial_frames['et_messages'] = et_messages
+    trial_frames['screen_sequence'] = screen_sequence
+    trial_frames['answers'] = answers
+    trial_frames['words'] = words
+    trial_frames['flags'] = flags
 
 
 def load_lines_text_by_screen(item_name, stimuli_path):
@@ -181,8 +213,8 @@ def load_lines_text_by_screen(item_name, stimuli_path):
 
 
 def load_lines_by_screen(item):
-    item_cfg = load_matfile(str(item))
-    lines, num_screens = item_cfg['lines'], len(item_cfg['screens'])
+    item_cfg = load_stimuli_text(item.stem, item.parent)
+    lines, num_screens = item_cfg['lines'], item_cfg['num_screens']
     screens_lines = {screen_id: [] for screen_id in range(1, num_screens + 1)}
     for line in lines:
         screens_lines[line['screen']].append({'text': line['text'],
@@ -191,16 +223,16 @@ def load_lines_by_screen(item):
     return screens_lines
 
 
-def load_calibrationdata(calibration_path):
-    cal_points = load_pickle(calibration_path, 'cal_points.pkl')
-    val_points = load_pickle(calibration_path, 'val_points.pkl')
-    val_offsets = load_pickle(calibration_path, 'val_offsets.pkl')
+def load_calibrationdata(trial_path):
+    calibration_frames = ['calibration/cal_points', 'calibration/val_points', 'calibration/val_offsets']
+    calibration = store.load_trial_frames(trial_path, calibration_frames)
+    cal_points, val_points, val_offsets = [calibration[name] for name in calibration_frames]
 
     return cal_points, val_points, val_offsets
 
 
-def load_screensequence(item_path, filename='screen_sequence.pkl'):
-    screen_sequence = pd.read_pickle(item_path / filename)
+def load_screensequence(item_path):
+    screen_sequence = load_trial_frame(item_path, 'screen_sequence')
     return screen_sequence
 
 
@@ -210,34 +242,82 @@ def load_stimuli(item, stimuli_path, config_file=None):
         raise ValueError('stimuli file does not exist: ' + str(stimuli_file))
     stimuli = load_matfile(str(stimuli_file))
     if config_file:
-        config = load_matfile(str(config_file))
-        short_stimuli_list = [stimuli_name.strip() for stimuli_name in config['short_stimuli']]
-        if item in short_stimuli_list:
-            stimuli['config'] = config['short_config']
-        else:
-            stimuli['config'] = config['long_config']
+        stimuli['config'] = item_config(item, load_matfile(str(config_file)))
 
     return stimuli
 
 
+def load_stimuli_text(item, stimuli_path):
+    """ Lines of the item (text, bbox, spaces_pos, etc.) and its number of screens, without decoding the images.
+        They are compiled once per stimuli file and kept in memory for subsequent calls. """
+    stimuli_file = stimuli_path / (item + '.mat')
+    if not stimuli_file.exists():
+        raise ValueError('stimuli file does not exist: ' + str(stimuli_file))
+    file_stat = stimuli_file.stat()
+    # Shallow copy, as callers add keys to it (e.g. config)
+    return dict(cached_stimuli_text(stimuli_file, file_stat.st_size, file_stat.st_mtime_ns))
+
+
+@lru_cache(maxsize=64)
+def cached_stimuli_text(stimuli_file, size, mtime_ns):
+    cache_file = stimuli_file.parent / STIMULI_CACHE / (stimuli_file.stem + '.pkl')
+    if cache_file.exists():
+        with cache_file.open('rb') as file:
+            stimuli_text = pickle.load(file)
+        if stimuli_text['source'] == (size, mtime_ns):
+            return stimuli_text
+
+    stimuli = load_matfile(stimuli_file)
+    stimuli_text = {'source': (size, mtime_ns), 'num_screens': len(stimuli['screens']),
+                    'lines': [{key: value for key, value in line.items() if key != 'image'}
+                              for line in stimuli['lines']]}
+    try:
+        cache_file.parent.mkdir(exist_ok=True)
+        tmp_file = cache_file.with_name(f'{cache_file.name}.{os.getpid()}.tmp')
+        with tmp_file.open('wb') as file:
+            pickle.dump(stimuli_text, file)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        # Read-only stimuli: keep the compiled text only in memory
+        pass
+    return stimuli_text
+
+
+def item_config(item, config):
+    short_stimuli_list = [stimuli_name.strip() for stimuli_name in config['short_stimuli']]
+    if item in short_stimuli_list:
+        return config['short_config']
+    else:
+        return config['long_config']
+
+
 def load_stimuli_screen(screenid, stimuli):
     return stimuli['screens'][screenid - 1]['image']
 
 
 def load_screen_fixations(screenid, item_path):
-    screen_path = get_screenpath(screenid, item_path)
-    fixations_files = screen_path.glob('fixations*.pkl')
-    screen_fixations = [pd.read_pickle(fix_file) for fix_file in sorted(fixations_files, reverse=True)]
+    screen_fixations = load_screen_visits(screenid, item_path, 'fixations')
     return screen_fixations
 
 
 def load_screen_linescoords(screenid, item_path):
-    screen_path = get_screenpath(screenid, item_path)
-    lines_files = screen_path.glob('lines*.pkl')
-    screen_lines = [pd.read_pickle(lines_file).to_numpy() for lines_file in sorted(lines_files, reverse=True)]
+    screen_lines = [lines.to_numpy() for lines in load_screen_visits(screenid, item_path, 'lines')]
     return screen_lines
 
 
+def load_screen_visits(screenid, item_path, kind):
+    # Last visit first, as they are popped following the screens sequence
+    visits = store.screen_visits(item_path, screenid, kind)[::-1]
+    visits_frames = store.load_trial_frames(item_path, visits)
+    return [visits_frames[visit] for visit in visits]
+
+
+def load_screen_visit(screenid, visit, item_path):
+    fix_frame, lines_frame = store.visit_frame(screenid, visit), store.visit_frame(screenid, visit, 'lines')
+    visit_frames = store.load_trial_frames(item_path, [fix_frame, lines_frame])
+    return visit_frames[fix_frame], visit_frames[lines_frame]
+
+
 def default_screen_linescoords(screenid, stimuli):
     linespacing = stimuli['config']['linespacing']
     screen_linescoords = [line['bbox'][1] - (linespacing // 2) for line in stimuli['lines'] if
@@ -249,16 +329,17 @@ def default_screen_linescoords(screenid, stimuli):
 
 
 def get_points_coords(val_msgs, num_points):
-    points = val_msgs['text'].str.extract(r'(\d+),(\d+)').astype(int)[:num_points]
-    points.columns = ['x', 'y']
-    return points
+    return val_msgs[['x', 'y']][:num_points].astype(int)
 
 
-def load_manualvaldata(manualval_path, trial_path):
-    et_msgs = load_pickle(trial_path, 'et_messages.pkl')
-    val_msgs = et_msgs[et_msgs['text'].str.contains('validation')]
-    manualval_points = get_points_coords(val_msgs, num_points=9)
-    manualval_fixs = [load_pickle(manualval_path, 'first.pkl'), load_pickle(manualval_path, 'last.pkl')]
+def load_manualvaldata(trial_path, num_points=9):
+    manualval_frames = store.load_trial_frames(trial_path, ['et_messages', 'manual_validation/first',
+                                                            'manual_validation/last'])
+    # Trials parsed before the messages were typed store them as raw text
+    et_msgs = et_utils.parse_messages(manualval_frames['et_messages'])
+    val_msgs = et_msgs[et_msgs['kind'] == 'manual_validation']
+    manualval_points = get_points_coords(val_msgs, num_points)
+    manualval_fixs = [manualval_frames['manual_validation/first'], manualval_frames['manual_validation/last']]
 
     return manualval_fixs, manualval_points
 
@@ -283,32 +364,40 @@ def save_measures_by_subj(item_measures, save_path):
         for subj in item_measures['subj'].unique():
             subj_measures = item_measures[item_measures['subj'] == subj]
             subj_measures.reset_index(drop=True, inplace=True)
-            subj_measures.to_pickle(save_path / f'{subj}.pkl')
+            store.save_partition(save_path, subj, subj_measures)
 
 
-def save_subjects_scanpaths(items_scanpaths, words_avg_measures, chars_mapping, save_path, measure=None):
+def save_subjects_scanpaths(items_scanpaths, words_avg_measures, chars_mapping, save_path, measure=None, jobs=None):
+    """ Each subject's scanpath file is written at once (replacing the previous one), items in parallel """
     dir_name = 'scanpaths'
     if measure is not None:
         dir_name += f'_{measure.lower()}'
-    for item in items_scanpaths:
-        item_scanpaths = items_scanpaths[item]
-        item_savepath = save_path / dir_name / item
-        if not item_savepath.exists():
-            item_savepath.mkdir(parents=True)
-        for subj in item_scanpaths:
-            subj_scanpath = get_scanpath_string(item_scanpaths[subj]['words'])
-            clean_words = [word.lower().translate(chars_mapping) for word in item_scanpaths[subj]['words']]
-            words_measures = words_avg_measures.loc[clean_words]
-            last_line_pos = 0
-            for line in subj_scanpath:
-                words = line.split()
-                line_measures = words_measures.iloc[last_line_pos:last_line_pos + len(words)]
-                line_measures = line_measures[measure].tolist() if measure is not None else [0] * len(words)
-                dump = {'text': line, 'fix_dur': line_measures}
-                with (item_savepath / f'{subj}.json').open('a') as f:
-                    f.write(json.dumps(dump))
-                    f.write('\n')
-                last_line_pos += len(words)
+    words_index = words_avg_measures.index
+    words_values = words_avg_measures[measure].to_numpy() if measure is not None else None
+    with ProcessPoolExecutor(jobs) as executor:
+        futures = [executor.submit(save_item_scanpaths, items_scanpaths[item], words_index, words_values,
+                                   chars_mapping, save_path / dir_name / item) for item in items_scanpaths]
+        for future in as_completed(futures):
+            future.result()
+
+
+def save_item_scanpaths(item_scanpaths, words_index, words_values, chars_mapping, item_savepath):
+    item_savepath.mkdir(parents=True, exist_ok=True)
+    for subj in item_scanpaths:
+        subj_scanpath = get_scanpath_string(item_scanpaths[subj]['words'])
+        clean_words = [word.lower().translate(chars_mapping) for word in item_scanpaths[subj]['words']]
+        words_rows = words_index.get_indexer(clean_words)
+        if (words_rows == -1).any():
+            raise KeyError(f'{[word for word, row in zip(clean_words, words_rows) if row == -1]} not in index')
+        lines, last_line_pos = [], 0
+        for line in subj_scanpath:
+            n_words = len(line.split())
+            line_rows = words_rows[last_line_pos:last_line_pos + n_words]
+            line_measures = words_values[line_rows].tolist() if words_values is not None else [0] * n_words
+            lines.append(json.dumps({'text': line, 'fix_dur': line_measures}) + '\n')
+            last_line_pos += n_words
+        with (item_savepath / f'{subj}.json').open('w') as f:
+            f.write(''.join(lines))
 
 
 def get_scanpath_string(scanpath):
@@ -318,23 +407,51 @@ def get_scanpath_string(scanpath):
     return subj_scanpath
 
 
-def average_measures(item_measures, measures, n_bins):
-    subjects_measures = []
-    for subj in item_measures['subj'].unique():
-        subj_measures = item_measures[item_measures['subj'] == subj]
-        for measure in measures:
-            measure_mask = subj_measures[measure] != 0
-            binarized = pd.qcut(subj_measures[measure][measure_mask], n_bins, labels=False,
-                                duplicates='drop')
-            subj_measures.loc[binarized.index, measure] = (binarized + 1).astype(int)
-        subjects_measures.append(subj_measures)
-    subjects_measures_df = pd.concat(subjects_measures)
+def bin_measures(measures_df, measures, n_bins, by=('subj',)):
+    """ Each subject's non-zero values of the given measures are replaced by their quantile bin (1 to n_bins),
+        as pd.qcut with duplicates='drop' does. Subjects are binned all at once; grouping by ('item', 'subj')
+        bins the measures of several items in a single pass. """
+    by = list(by)
     # sanity checks: each word_idx corresponds to the same word and each subject has all word_idx
-    assert all(subjects_measures_df.groupby('word_idx')['word'].nunique() == 1)
-    assert all(subjects_measures_df.groupby('subj')['word_idx'].nunique() ==
-               subjects_measures_df['word_idx'].nunique())
-    all_measures = measures + ['FC', 'RC', 'LS', 'RR']
-    averaged_measures = subjects_measures_df[['word_idx'] + all_measures].groupby(['word_idx']).mean()
-    averaged_measures['word'] = subjects_measures_df.loc[averaged_measures.index, 'word']
-    averaged_measures['excluded'] = subjects_measures_df.loc[averaged_measures.index, 'excluded']
-    return averaged_measures
+    words_keys = [column for column in by if column != 'subj'] + ['word_idx']
+    assert all(measures_df.groupby(words_keys, observed=True)['word'].nunique() == 1)
+    words_per_subject = measures_df.groupby(by, observed=True)['word_idx'].nunique()
+    if len(words_keys) > 1:
+        assert all(words_per_subject == measures_df.groupby(words_keys[:-1], observed=True)['word_idx'].nunique()
+                   .reindex(words_per_subject.index.droplevel('subj')).to_numpy())
+    else:
+        assert all(words_per_subject == measures_df['word_idx'].nunique())
+
+    groups = measures_df.groupby(by, observed=True, sort=False).ngroup().to_numpy()
+    binned_measures = measures_df.copy()
+    for measure in measures:
+        values = measures_df[measure].to_numpy(dtype=float)
+        nonzero = np.flatnonzero(values != 0)
+        values[nonzero] = quantile_bins(values[nonzero], groups[nonzero], n_bins) + 1
+        binned_measures[measure] = values.astype(measures_df[measure].dtype)
+    return binned_measures
+
+
+def quantile_bins(values, groups, n_bins):
+    """ Quantile bin (0 to n_bins - 1) of each value within its group. Edges are the quantiles of the group, with
+        linear interpolation and duplicated edges dropped, and each bin includes its right edge (as in pd.qcut).
+        Groups where all the values are equal are left in a single bin. """
+    order = np.lexsort((values, groups))
+    sorted_values = values[order]
+    _, starts, counts = np.unique(groups[order], return_index=True, return_counts=True)
+    # Same arithmetic as np.percentile (which pd.qcut relies on), so that values equal to an edge are binned alike
+    quantiles = np.linspace(0, 1, n_bins + 1) * 100 / 100
+    virtual_idx = (counts[:, None] - 1) * quantiles
+    lower_idx = np.floor(virtual_idx)
+    gamma = virtual_idx - lower_idx
+    lower_idx = np.minimum(lower_idx.astype(int), counts[:, None] - 1)
+    upper_idx = np.minimum(lower_idx + 1, counts[:, None] - 1)
+    lower, upper = sorted_values[starts[:, None] + lower_idx], sorted_values[starts[:, None] + upper_idx]
+    edges = np.where(gamma >= 0.5, upper - (upper - lower) * (1 - gamma), lower + (upper - lower) * gamma)
+
+    distinct_edges = np.concatenate([np.ones((len(edges), 1), dtype=bool), edges[:, 1:] != edges[:, :-1]], axis=1)
+    values_group = np.repeat(np.arange(len(counts)), counts)
+    lower_edges = (edges[values_group] < sorted_values[:, None]) & distinct_edges[values_group]
+    bins = np.empty(len(values), dtype=int)
+    bins[order] = np.maximum(lower_edges.sum(axis=1) - 1, 0)
+    return bins
@@ -1,6 +1,6 @@
 import numpy as np
 import pandas as pd
-from scripts.data_processing.utils import load_matfile, get_dirs, load_answers
+from scripts.data_processing.utils import load_questions, get_dirs, load_answers
 
 DEACC = {'á': 'a', 'é': 'e', 'í': 'i', 'ó': 'o', 'ú': 'u'}
 
@@ -24,7 +24,7 @@ WORDS_MAPPING = {
 
 
 def parse_wa_task(questions_file, participants_path):
-    questions = load_matfile(str(questions_file))['stimuli_questions']
+    questions = load_questions(questions_file)
     subjects = get_dirs(participants_path)
     items_words = {}
     subjects_associations = {}
@@ -38,7 +38,7 @@ def parse_wa_task(questions_file, participants_path):
             item_words = map(parse_cue, items_words[item])
             trial_answers = []
             if item in subj_trials:
-                trial_answers = load_answers(subj_trials[item], filename='words.pkl')
+                trial_answers = load_answers(subj_trials[item], 'words')
             for i, word in enumerate(item_words):
                 answer = None
                 if i < len(trial_answers):